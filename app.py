@@ -1,22 +1,70 @@
 import os
+import cProfile
+import csv
+import gzip
+import hashlib
+import io
+import json
+import heapq
+import logging
+import mmap
+import pickle
+import random
+import re
+import secrets
+import struct
+import sys
+import threading
 import time
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory, g, jsonify, \
+    Response, has_request_context, make_response
+from flask.sessions import SessionInterface, SessionMixin
+import click
+from flask.cli import AppGroup
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from flask_migrate import Migrate, upgrade as upgrade_schema, stamp as stamp_schema
+from sqlalchemy import case, event, func, inspect, or_, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.dialects.mysql import match, insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.datastructures import CallbackDict
+from werkzeug.http import is_resource_modified
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from config import Config
-from flask_admin import Admin
+from flask_admin import Admin, BaseView, expose
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.form import Select2Widget
-from wtforms import Form, SelectField, StringField, IntegerField, FloatField, DateField, TextAreaField
-from wtforms.validators import InputRequired, NumberRange
-from functools import cached_property
-# ждем пока бд запустится
-time.sleep(10)
+from wtforms import Form, FileField, SelectField, StringField, IntegerField, FloatField, DateField, TextAreaField
+from wtforms.validators import InputRequired, NumberRange, ValidationError
+from functools import wraps
+from itertools import accumulate, groupby
+from operator import itemgetter
+from urllib.parse import urlencode
+from bisect import bisect_right
+from array import array
+from collections import namedtuple, OrderedDict
+from markupsafe import Markup
+import jinja2
+from PIL import Image, ImageOps
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+try:
+    import brotli
+except ImportError:
+    # без пакета Brotli сжимаем только gzip
+    brotli = None
 app = Flask(__name__)
 app.config.from_object(Config)
 db = SQLAlchemy(app)
+# миграции схемы: flask db upgrade / flask db migrate
+migrate = Migrate(app, db)
+
+# денежные суммы округляем до копеек
+CENTS = Decimal('0.01')
 
 # повторяем модели
 # тип пользователя
@@ -38,12 +86,36 @@ class Users(db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     phone = db.Column(db.String(20))
     email = db.Column(db.String(150), unique=True, nullable=False)
-    balance = db.Column(db.Float, default=0.0)
+    balance = db.Column(db.Numeric(10, 2), default=0)
+    # растет при каждом изменении баланса, запись в журнале хранит версию после изменения
+    balance_version = db.Column(db.Integer, nullable=False, default=0)
     registration_date = db.Column(db.DateTime, default=datetime.utcnow)
     addresses = db.relationship('Address', backref='user', lazy=True)
     carts = db.relationship('Cart', backref='user', lazy=True)
     orders = db.relationship('Order', backref='user', lazy=True)
 
+# журнал операций по балансу, записи только добавляются
+class BalanceLedger(db.Model):
+    __tablename__ = 'balance_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    reason = db.Column(db.String(50), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order_table.id'))
+    balance_version = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_balance_ledger_user_version', 'user_id', 'balance_version'),
+    )
+
+# снимок баланса: журнал после снимка (по версии) + снимок = баланс пользователя
+class BalanceSnapshot(db.Model):
+    __tablename__ = 'balance_snapshot'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    balance = db.Column(db.Numeric(10, 2), nullable=False)
+    balance_version = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # адрес
 class Address(db.Model):
     __tablename__ = 'address'
@@ -55,6 +127,9 @@ class Address(db.Model):
     postal_code = db.Column(db.String(20))
     house = db.Column(db.String(50))
     country = db.Column(db.String(100))
+    __table_args__ = (
+        db.Index('ix_address_user_type', 'user_id', 'address_type'),
+    )
 
 # товар
 class Product(db.Model):
@@ -72,15 +147,23 @@ class Book(db.Model):
     __tablename__ = 'book'
     id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
     isbn = db.Column(db.String(20), unique=True)
-    title = db.Column(db.String(255), nullable=False)
-    publisher = db.Column(db.String(150))
-    publish_date = db.Column(db.Date)
+    title = db.Column(db.String(255), nullable=False, index=True)
+    publisher = db.Column(db.String(150), index=True)
+    publish_date = db.Column(db.Date, index=True)
     description = db.Column(db.Text)
-    genre = db.Column(db.String(100))
+    genre = db.Column(db.String(100), index=True)
     quantity = db.Column(db.Integer, default=0)
     pages = db.Column(db.Integer)
     reserved_quantity = db.Column(db.Integer, default=0)
-    authors = db.relationship('Author', secondary='book_author', backref='books', lazy=True)
+    # цена со скидкой, копия из product для сортировки и фильтров по индексу (см. sync_final_prices)
+    final_price = db.Column(db.Numeric(10, 2), index=True)
+    # сколько можно купить: считает сама БД при каждом изменении остатка или брони
+    available_quantity = db.Column(db.Integer, db.Computed('quantity - reserved_quantity', persisted=True), index=True)
+    # author.books - запрос (dynamic), а не список: у автора могут быть тысячи книг, грузим их только постранично
+    authors = db.relationship('Author', secondary='book_author', backref=db.backref('books', lazy='dynamic'), lazy=True)
+    __table_args__ = (
+        db.Index('ft_book_search', 'title', 'genre', 'description', mysql_prefix='FULLTEXT'),
+    )
 
 # автор
 class Author(db.Model):
@@ -92,17 +175,24 @@ class Author(db.Model):
     birth_date = db.Column(db.Date)
     country = db.Column(db.String(100))
     biography = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ft_author_name', 'first_name', 'last_name', 'middle_name', mysql_prefix='FULLTEXT'),
+        # поиск автора по имени при импорте каталога
+        db.Index('ix_author_name', 'last_name', 'first_name'),
+    )
 
 # соотношение книга-автор
 book_author = db.Table('book_author', db.Column('author_id', db.Integer, db.ForeignKey('author.id'), primary_key=True),
-                       db.Column('book_id', db.Integer, db.ForeignKey('book.id'), primary_key=True)
+                       db.Column('book_id', db.Integer, db.ForeignKey('book.id'), primary_key=True),
+                       # первичный ключ начинается с author_id, авторов книги ищем по этому индексу
+                       db.Index('ix_book_author_book_id', 'book_id')
                        )
 
 # корзина
 class Cart(db.Model):
     __tablename__ = 'cart'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     items = db.relationship('CartItem', backref='cart', lazy=True)
 
 # элемент корзины
@@ -112,16 +202,36 @@ class CartItem(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
     quantity = db.Column(db.Integer, default=1)
 
+# бронь товара под корзину, пока она не истекла, экземпляры учтены в book.reserved_quantity
+class StockReservation(db.Model):
+    __tablename__ = 'stock_reservation'
+    cart_id = db.Column(db.Integer, db.ForeignKey('cart.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# статусы заказа и допустимые переходы
+ORDER_STATUSES = ['обрабатывается', 'оплачен', 'собирается', 'отправлен', 'доставлен', 'отменен']
+ORDER_TRANSITIONS = {
+    'обрабатывается': {'оплачен', 'отменен'},
+    'оплачен': {'собирается', 'отменен'},
+    'собирается': {'отправлен', 'отменен'},
+    'отправлен': {'доставлен'},
+}
+
 # заказ
 class Order(db.Model):
     __tablename__ = 'order_table'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     delivery_address_id = db.Column(db.Integer, db.ForeignKey('address.id'))
     payment_address_id = db.Column(db.Integer, db.ForeignKey('address.id'))
     payment_method = db.Column(db.String(50))
     status = db.Column(db.String(50), default='обрабатывается')
     total_amount = db.Column(db.Numeric(10, 2), default=0)
+    order_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # учтен ли заказ в sales_daily: прибавляют и вычитают только по смене этого флага
+    counted_in_sales = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
     delivery_address = db.relationship('Address', foreign_keys=[delivery_address_id])
     payment_address = db.relationship('Address', foreign_keys=[payment_address_id])
     items = db.relationship('OrderItem', backref='order', lazy=True)
@@ -134,27 +244,158 @@ class OrderItem(db.Model):
     quantity = db.Column(db.Integer, default=1)
     price_at_purchase = db.Column(db.Numeric(10, 2))
 
+# очередь задач по заказам (outbox): что сделать после коммита, выполняет flask orders worker
+class OrderJob(db.Model):
+    __tablename__ = 'order_job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order_table.id'))
+    payload = db.Column(db.Text)
+    # pending -> done или failed после ORDER_JOB_MAX_ATTEMPTS попыток
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_order_job_status_run_at', 'status', 'run_at'),
+    )
+
+# дневные итоги продаж для отчетов: dimension - total, book, genre или author, dimension_key - id книги или автора,
+# жанр, для total - пусто. заказ добавляется задачей order_placed и вычитается при отмене, flask reports rebuild пересчитывает
+class SalesDaily(db.Model):
+    __tablename__ = 'sales_daily'
+    dimension = db.Column(db.String(10), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    dimension_key = db.Column(db.String(255), primary_key=True, default='')
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+
+# обложки: book_{id}.{ext}, при нескольких файлах берется первый по порядку расширений
+COVERS_DIR = os.path.join(app.static_folder, 'uploads', 'books')
+COVER_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif']
+# миниатюры: book_{id}-{размер}-{хэш}.{webp|jpg}, хэш от содержимого обложки и параметров размера,
+# поэтому файл с таким именем никогда не меняется и кэшируется браузером надолго
+THUMBS_DIR = os.path.join(app.static_folder, 'uploads', 'thumbs')
+THUMB_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+THUMB_NAME = re.compile(r'book_(\d+)-(\w+)-([0-9a-f]+)\.(webp|jpg)$')
+# манифест обложек: id книги -> имя файла, миниатюры: id -> {размер: {формат: имя}}, mtime папок на момент сканирования
+cover_manifest = {'files': {}, 'thumbs': {}, 'mtime': None, 'checked_at': 0.0}
+
+def covers_mtime():
+    mtimes = []
+    for path in (COVERS_DIR, THUMBS_DIR):
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+def scan_dir(path):
+    try:
+        return list(os.scandir(path))
+    except FileNotFoundError:
+        return []
+
+# сканирует папки с обложками и миниатюрами один раз вместо os.path.exists на каждую книгу
+def load_cover_manifest():
+    mtime = covers_mtime()
+    files = {}
+    for entry in scan_dir(COVERS_DIR):
+        name, _, ext = entry.name.rpartition('.')
+        book_id = name[len('book_'):]
+        if not name.startswith('book_') or not book_id.isdigit() or ext not in COVER_EXTENSIONS:
+            continue
+        current = files.get(int(book_id))
+        if current is None or COVER_EXTENSIONS.index(ext) < COVER_EXTENSIONS.index(current.rpartition('.')[2]):
+            files[int(book_id)] = entry.name
+    thumbs = {}
+    for entry in scan_dir(THUMBS_DIR):
+        found = THUMB_NAME.match(entry.name)
+        if not found:
+            continue
+        book_id, size, _, fmt = found.groups()
+        formats = thumbs.setdefault(int(book_id), {}).setdefault(size, {})
+        # старые версии остаются до flask covers build --prune, берем самую новую
+        if fmt not in formats or entry.stat().st_mtime > os.stat(os.path.join(THUMBS_DIR, formats[fmt])).st_mtime:
+            formats[fmt] = entry.name
+    # подменяем словари целиком, чтобы параллельные запросы не видели их наполовину
+    cover_manifest.update(files=files, thumbs=thumbs, mtime=mtime, checked_at=time.monotonic())
+    return files
+
+# сбрасывает манифест (после загрузки/удаления обложки)
+def invalidate_cover_manifest():
+    cover_manifest['checked_at'] = 0.0
+    cover_manifest['mtime'] = None
+
+# манифест с проверкой mtime папок не чаще раза в COVER_MANIFEST_CHECK_INTERVAL секунд
+def get_cover_manifest():
+    if time.monotonic() - cover_manifest['checked_at'] >= app.config['COVER_MANIFEST_CHECK_INTERVAL']:
+        mtime = covers_mtime()
+        if None in mtime or mtime != cover_manifest['mtime']:
+            load_cover_manifest()
+        else:
+            cover_manifest['checked_at'] = time.monotonic()
+    return cover_manifest
+
 # возвращает путь к книге для шаблонов
 def get_book_cover_path(book):
     if not book or not book.id:
         return None
-    # проверяем файлы по шаблону book_{id}.*
-    for ext in ['jpg', 'jpeg', 'png', 'gif']:
-        filename = f"book_{book.id}.{ext}"
-        full_path = os.path.join('static/uploads/books', filename)
-        if os.path.exists(full_path):
-            return f"uploads/books/{filename}"
+    filename = get_cover_manifest()['files'].get(book.id)
+    if filename:
+        return f"uploads/books/{filename}"
     return None
 
+# обложка нужного размера для шаблонов: {'src': jpg, 'webp': webp или None};
+# пока миниатюр нет - исходный файл
+def get_book_cover(book, size):
+    cover_path = get_book_cover_path(book)
+    if not cover_path:
+        return None
+    formats = get_cover_manifest()['thumbs'].get(book.id, {}).get(size, {})
+    if 'jpg' not in formats:
+        return {'src': url_for('static', filename=cover_path), 'webp': None}
+    return {
+        'src': url_for('cover_thumb', filename=formats['jpg']),
+        'webp': url_for('cover_thumb', filename=formats['webp']) if 'webp' in formats else None
+    }
+
+# создает недостающие миниатюры одной обложки; запускается и в процессах flask covers build.
+# возвращает (имена актуальных миниатюр, сколько создано)
+def build_thumbnails(filename):
+    with open(os.path.join(COVERS_DIR, filename), 'rb') as f:
+        data = f.read()
+    book_id = filename[len('book_'):].rpartition('.')[0]
+    quality = app.config['COVER_THUMB_QUALITY']
+    names, created = [], 0
+    image = None
+    for size, box in app.config['COVER_THUMB_SIZES'].items():
+        digest = hashlib.sha1(data + f'{box}:{quality}'.encode()).hexdigest()[:12]
+        for fmt, pil_format in THUMB_FORMATS.items():
+            name = f'book_{book_id}-{size}-{digest}.{fmt}'
+            names.append(name)
+            target = os.path.join(THUMBS_DIR, name)
+            if os.path.exists(target):
+                continue
+            if image is None:
+                image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')
+            thumb = image.copy()
+            thumb.thumbnail(box, Image.LANCZOS)
+            # пишем во временный файл и переименовываем, чтобы не отдать недописанную картинку
+            thumb.save(target + '.tmp', pil_format, quality=quality, optimize=True)
+            os.replace(target + '.tmp', target)
+            created += 1
+    return names, created
+
+load_cover_manifest()
+
 # защита админки
 class AdminModelView(ModelView):
-    @cached_property
-    def _is_accessible(self):
-        user = get_current_user()
-        return user and user.user_type_id == 1
-    
+    # представление одно на все запросы, поэтому проверяем на каждом запросе - по данным сессии, без запроса к БД
     def is_accessible(self):
-        return self._is_accessible
+        return is_admin()
     
     def inaccessible_callback(self, name, **kwargs):
         return redirect(url_for('login'))
@@ -177,15 +418,21 @@ class BookModelView(AdminModelView):
 
     form_columns = [
         'title', 'isbn', 'publisher', 'publish_date', 'description',
-        'genre', 'quantity', 'pages', 'reserved_quantity', 'authors'
+        'genre', 'quantity', 'pages', 'reserved_quantity', 'price', 'discount', 'authors', 'cover'
     ]
 
-    column_list = ['id', 'title', 'isbn', 'genre', 'quantity']
+    column_list = ['id', 'cover', 'title', 'isbn', 'genre', 'quantity']
+    # загрузка обложки из формы книги; цена и скидка хранятся в товаре книги
+    form_extra_fields = {
+        'cover': FileField('Обложка'),
+        'price': BookForm.price,
+        'discount': BookForm.discount
+    }
     # показ. превью обложки
     def _cover_formatter(view, context, model, name):
-        cover_path = get_book_cover_path(model)
-        if cover_path:
-            return f'<img src="/static/{cover_path}" style="max-height: 50px;">'
+        cover = get_book_cover(model, 'admin')
+        if cover:
+            return Markup(f'<img src="{cover["src"]}" style="max-height: 50px;">')
         return "Нет обложки"
     column_formatters = {
         'cover': _cover_formatter
@@ -195,6 +442,152 @@ class BookModelView(AdminModelView):
         'cover': 'Обложка'
     }
 
+    def on_form_prefill(self, form, id):
+        product = Product.query.get(id)
+        if product:
+            form.price.data = float(product.price)
+            form.discount.data = float(product.discount or 0)
+
+    # у новой книги создаем товар: id книги берется из него при flush. final_price пересчитает sync_book_final_price
+    def on_model_change(self, form, model, is_created):
+        product = model.product
+        if product is None:
+            if form.price.data is None:
+                raise ValidationError('Укажите цену')
+            product = Product(product_type='book')
+            model.product = product
+        if form.price.data is not None:
+            product.price = Decimal(str(form.price.data))
+        if form.discount.data is not None:
+            product.discount = Decimal(str(form.discount.data))
+        self.validate_cover(form.cover.data)
+
+    # обложку проверяем до сохранения книги: ошибка здесь откатывает изменение и показывается в форме
+    @staticmethod
+    def validate_cover(upload):
+        if not upload or not upload.filename:
+            return
+        if upload.filename.rpartition('.')[2].lower() not in COVER_EXTENSIONS:
+            raise ValidationError('Обложка должна быть в формате ' + ', '.join(COVER_EXTENSIONS))
+        try:
+            Image.open(upload.stream).verify()
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+            raise ValidationError('Файл обложки не является изображением')
+        finally:
+            upload.stream.seek(0)
+
+    # выбранные в списке книги - в форму массового изменения
+    @action('bulk_update', 'Массовое изменение')
+    def action_bulk_update(self, ids):
+        isbns = db.session.execute(select(Book.isbn).where(Book.id.in_(ids))).scalars()
+        return redirect(url_for('bulk.index', isbns=' '.join(isbn for isbn in isbns if isbn)))
+
+    # новая обложка заменяет файлы с другими расширениями, миниатюры строим сразу
+    def after_model_change(self, form, model, is_created):
+        upload = form.cover.data
+        if not upload or not upload.filename:
+            return
+        ext = upload.filename.rpartition('.')[2].lower()
+        os.makedirs(COVERS_DIR, exist_ok=True)
+        os.makedirs(THUMBS_DIR, exist_ok=True)
+        for other in COVER_EXTENSIONS:
+            path = os.path.join(COVERS_DIR, f'book_{model.id}.{other}')
+            if other != ext and os.path.exists(path):
+                os.remove(path)
+        upload.save(os.path.join(COVERS_DIR, f'book_{model.id}.{ext}'))
+        try:
+            build_thumbnails(f'book_{model.id}.{ext}')
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # заголовок прошел проверку, но картинка не читается целиком - битую обложку не оставляем
+            os.remove(os.path.join(COVERS_DIR, f'book_{model.id}.{ext}'))
+            flash(f'Не удалось обработать обложку: {str(e)}', 'error')
+        invalidate_cover_manifest()
+        for key in cache_keys_for(db.session.connection(), model):
+            page_cache.incr_version(key)
+
+# книги автора в админке не показываем: форма загрузила бы весь список книг автора и все книги для выбора.
+# связь правится со стороны книги
+class AuthorModelView(AdminModelView):
+    form_excluded_columns = ['books']
+
+# статус заказа в админке - только по разрешенным переходам, с теми же задачами, что и flask orders set-status
+class OrderModelView(AdminModelView):
+    form_choices = {
+        'status': [(status, status) for status in ORDER_STATUSES]
+    }
+
+    def on_model_change(self, form, model, is_created):
+        history = inspect(model).attrs.status.history
+        if is_created or not history.deleted or history.deleted[0] == model.status:
+            return
+        if model.status not in ORDER_TRANSITIONS.get(history.deleted[0], ()):
+            raise ValidationError(f"Нельзя перевести заказ из статуса '{history.deleted[0]}' в '{model.status}'")
+        order_status_changed(model.id, model.status)
+
+# свои страницы админки - с той же проверкой доступа, что и у моделей
+class AdminBaseView(BaseView):
+    def is_accessible(self):
+        return is_admin()
+
+    def inaccessible_callback(self, name, **kwargs):
+        return redirect(url_for('login'))
+
+# массовое изменение цен, скидок и остатков по фильтру: "Проверить" показывает число книг, "Применить" меняет их
+class BulkUpdateView(AdminBaseView):
+    @expose('/', methods=['GET', 'POST'])
+    def index(self):
+        values = request.values
+        filters = {name: values.get(name, '').strip() for name in ('genre', 'publisher', 'author', 'isbns')}
+        operation = values.get('operation', 'discount')
+        preview = None
+        if request.method == 'POST':
+            value = parse_decimal(values.get('value', '').strip().replace(',', '.'))
+            isbns = [isbn for isbn in re.split(r'[\s,;]+', filters['isbns']) if isbn]
+            conditions = bulk_conditions(filters['genre'], filters['publisher'], filters['author'], isbns)
+            error = check_bulk_value(operation, value) or (None if conditions else 'Укажите хотя бы один фильтр')
+            if error:
+                flash(error, 'error')
+            elif 'apply' in values:
+                flash(f'Изменено книг: {bulk_update(operation, value, conditions)}', 'success')
+                return redirect(url_for('.index'))
+            else:
+                preview = count_bulk_targets(conditions)
+        return self.render('admin/bulk.html', filters=filters, operation=operation, value=values.get('value', ''),
+                           operations=BULK_OPERATIONS, preview=preview)
+
+# отчет по продажам из дневных итогов: по дням и лучшие книги, жанры и авторы за период
+class SalesReportView(AdminBaseView):
+
+    @expose('/')
+    def index(self):
+        days = max(1, min(request.args.get('days', 30, type=int), 366))
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+        daily = SalesDaily.query.filter(SalesDaily.dimension == 'total', SalesDaily.day >= since).order_by(
+            SalesDaily.day.desc()).all()
+        top = {dimension: self.top(dimension, since) for dimension in ('book', 'genre', 'author')}
+        totals = {
+            'orders': sum(row.orders for row in daily),
+            'units': sum(row.units for row in daily),
+            'revenue': sum((row.revenue for row in daily), Decimal('0.00')),
+        }
+        return self.render('admin/sales.html', days=days, daily=daily, top=top, totals=totals)
+
+    # лучшие по выручке за период: [(название, заказов, штук, выручка)]
+    def top(self, dimension, since):
+        revenue = func.sum(SalesDaily.revenue)
+        rows = db.session.query(SalesDaily.dimension_key, func.sum(SalesDaily.orders), func.sum(SalesDaily.units), revenue).filter(
+            SalesDaily.dimension == dimension, SalesDaily.day >= since
+        ).group_by(SalesDaily.dimension_key).order_by(revenue.desc()).limit(app.config['SALES_REPORT_TOP']).all()
+        labels = {}
+        ids = [int(row[0]) for row in rows] if dimension != 'genre' else []
+        if dimension == 'book' and ids:
+            labels = dict(db.session.query(Book.id, Book.title).filter(Book.id.in_(ids)).all())
+        elif dimension == 'author' and ids:
+            labels = {row.id: format_author_name(row.first_name, row.last_name, row.middle_name) for row in db.session.query(
+                Author.id, Author.first_name, Author.last_name, Author.middle_name).filter(Author.id.in_(ids))}
+        return [(labels.get(int(key), f'#{key}') if dimension != 'genre' else key, orders, units, total)
+                for key, orders, units, total in rows]
+
 # админ панель фласка
 admin = Admin(app, name='Admin', template_mode='bootstrap3')
 admin.add_view(AdminModelView(UserType, db.session))
@@ -202,72 +595,1818 @@ admin.add_view(AdminModelView(Users, db.session, name='User'))
 admin.add_view(AdminModelView(Address, db.session))
 admin.add_view(AdminModelView(Product, db.session))
 admin.add_view(BookModelView(Book, db.session, name='Book'))
-admin.add_view(AdminModelView(Author, db.session))
-admin.add_view(AdminModelView(Order, db.session))
+admin.add_view(AuthorModelView(Author, db.session))
+admin.add_view(OrderModelView(Order, db.session))
+admin.add_view(SalesReportView(name='Продажи', endpoint='sales'))
+admin.add_view(BulkUpdateView(name='Массовые изменения', endpoint='bulk'))
 admin.add_view(AdminModelView(OrderItem, db.session))
 
 # ошибки и ошибка пэйдж
 @app.errorhandler(Exception)
 def handle_exception(e):
-    print(f"Произошла ошибка: {str(e)}")
+    app.logger.exception(f"Произошла ошибка: {str(e)}")
     return render_template('error.html'), 500
 
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('error.html', error_message="Страница не найдена"), 404
 
-@app.route('/static/<path:subpath>')
-def static_files(subpath):
-    return send_from_directory('static', subpath)
+# миниатюры обложек: имя меняется вместе с содержимым, поэтому кэш на год и без перепроверки
+@app.route('/covers/<filename>')
+def cover_thumb(filename):
+    # etag передаем явно: во Flask 2.0.1 по умолчанию он не ставится
+    response = send_from_directory(THUMBS_DIR, filename, max_age=app.config['COVER_THUMB_MAX_AGE'], etag=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# роль берем из сессии: при смене роли или пароля сессии пользователя отзываются
+def is_admin():
+    return session.get('user_type_id') == 1
 
+# текущий пользователь, загружается не больше одного раза за запрос
 def get_current_user():
-    if 'user_id' in session:
-        user = Users.query.get(session['user_id'])
-        if user:
-            return user
-    return None
+    if 'current_user' not in g:
+        g.current_user = Users.query.get(session['user_id']) if 'user_id' in session else None
+    return g.current_user
+
+# горячие поля пользователя для шапки сайта и проверок доступа
+UserSummary = namedtuple('UserSummary', ['id', 'username', 'user_type_id', 'balance'])
+# кэш UserSummary на процесс: user_id -> (время истечения, summary)
+user_cache = {}
+
+def get_user_summary():
+    if 'user_id' not in session:
+        return None
+    user_id = session['user_id']
+    # если пользователь уже загружен в этом запросе, второй запрос не нужен
+    if g.get('current_user') is not None:
+        user = g.current_user
+        return UserSummary(user.id, user.username, user.user_type_id, user.balance)
+    ttl = app.config['USER_CACHE_TTL']
+    cached = user_cache.get(user_id)
+    if ttl and cached and cached[0] > time.monotonic():
+        return cached[1]
+    row = db.session.query(Users.id, Users.username, Users.user_type_id, Users.balance).filter_by(id=user_id).first()
+    summary = UserSummary(*row) if row else None
+    if ttl and summary:
+        if len(user_cache) >= app.config['USER_CACHE_SIZE']:
+            user_cache.clear()
+        user_cache[user_id] = (time.monotonic() + ttl, summary)
+    return summary
+
+# сбрасывает кэш при любом изменении пользователя через ORM
+@event.listens_for(Users, 'after_update')
+@event.listens_for(Users, 'after_delete')
+def invalidate_user_cache(mapper, connection, user):
+    user_cache.pop(user.id, None)
+
+# сессия хранит роль пользователя, поэтому после смены роли, пароля или удаления она недействительна.
+# отзываем после коммита: откат flush никого не разлогинивает. id пользователя -> новая роль (None - удален)
+@event.listens_for(Users, 'after_update')
+def revoke_changed_user_sessions(mapper, connection, user):
+    state = inspect(user)
+    if state.attrs.user_type_id.history.has_changes() or state.attrs.password_hash.history.has_changes():
+        db.session.info.setdefault('revoked_users', {})[user.id] = user.user_type_id
+
+@event.listens_for(Users, 'after_delete')
+def revoke_deleted_user_sessions(mapper, connection, user):
+    db.session.info.setdefault('revoked_users', {})[user.id] = None
+
+# текущую сессию пользователя, сменившего свой пароль, не разлогиниваем: новый id и новое время входа
+@event.listens_for(db.session, 'after_commit')
+def apply_revoked_user_sessions(db_session):
+    for user_id, user_type_id in db_session.info.pop('revoked_users', {}).items():
+        revoke_user_sessions(user_id)
+        if user_type_id is not None and has_request_context() and session.get('user_id') == user_id:
+            session.regenerate()
+            session['user_type_id'] = user_type_id
+            session['_login_at'] = time.time()
+
+@event.listens_for(db.session, 'after_rollback')
+def drop_revoked_user_sessions(db_session):
+    db_session.info.pop('revoked_users', None)
 
 # контекстный процессор
 @app.context_processor
 def inject_user():
     return {
-        'user': get_current_user(),
+        'user': get_user_summary(),
         'get_book_price_with_discount': get_book_price_with_discount,
-        'get_book_cover_path': get_book_cover_path
+        'get_book_cover': get_book_cover,
+        'render_book_card': render_book_card
     }
 
+# цена со скидкой в Decimal, округленная до копеек
+def price_with_discount(price, discount):
+    price = Decimal(price)
+    discount = Decimal(discount or 0)
+    if discount > 0:
+        price = price * (100 - discount) / 100
+    return price.quantize(CENTS, rounding=ROUND_HALF_UP)
+
 # возвращает цену книги с уч скидки
 def get_book_price_with_discount(book):
-    price = float(book.product.price)
-    discount = float(book.product.discount or 0)
-    if discount > 0:
-        return price * (1 - discount / 100)
-    return price
+    if book.final_price is not None:
+        return book.final_price
+    return price_with_discount(book.product.price, book.product.discount)
+
+# итоговая цена одним выражением SQL - для массовых изменений и проверки;
+# делим на 100.0, иначе sqlite делит целую цену нацело и копейки теряются
+def final_price_expression():
+    return select(
+        func.round(Product.price * (100 - func.coalesce(Product.discount, 0)) / 100.0, 2)
+    ).where(Product.id == Book.id).scalar_subquery()
+
+# пересчитывает book.final_price после массовых изменений цен мимо ORM; возвращает число исправленных книг
+def sync_final_prices(book_ids=None):
+    price = final_price_expression()
+    query = Book.query.filter(or_(Book.final_price.is_(None), Book.final_price != price))
+    if book_ids is not None:
+        query = query.filter(Book.id.in_(book_ids))
+    return query.update({Book.final_price: price}, synchronize_session=False)
+
+# изменения цены и скидки через ORM (админка, оформление) пересчитывают final_price до flush
+@event.listens_for(db.session, 'before_flush')
+def sync_book_final_price(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Product):
+            attrs = inspect(obj).attrs
+            if obj in session.new or attrs.price.history.has_changes() or attrs.discount.history.has_changes():
+                if obj.book is not None and obj.price is not None:
+                    obj.book.final_price = price_with_discount(obj.price, obj.discount)
+        elif isinstance(obj, Book) and obj in session.new:
+            product = obj.product
+            # товар мог быть создан отдельно и связан только по id, в том числе в этом же flush
+            if product is None and obj.id is not None:
+                product = next((new for new in session.new if isinstance(new, Product) and new.id == obj.id), None)
+            if product is None and obj.id is not None:
+                with session.no_autoflush:
+                    product = session.get(Product, obj.id)
+            if product is not None and product.price is not None:
+                obj.final_price = price_with_discount(product.price, product.discount)
+
+# позиции корзины с ценами: товары и книги одним запросом с join, авторы - одним selectin.
+# результат используют и корзина, и оформление заказа
+def get_priced_cart(cart_id):
+    cart_items = CartItem.query.filter_by(cart_id=cart_id).options(
+        joinedload(CartItem.product, innerjoin=True).joinedload(Product.book, innerjoin=True)
+        .selectinload(Book.authors)
+    ).all()
+    return price_cart_items([(item.product, item.quantity, item) for item in cart_items])
+
+# [(товар, количество, позиция корзины или None)] -> позиции с ценами и сумма
+def price_cart_items(rows):
+    items = []
+    total = Decimal('0.00')
+    for product, quantity, cart_item in rows:
+        final_price = price_with_discount(product.price, product.discount)
+        item_total = final_price * quantity
+        total += item_total
+        items.append({
+            'cart_item': cart_item,
+            'product': product,
+            'book': product.book,
+            'quantity': quantity,
+            'original_price': product.price,
+            'discount': product.discount or 0,
+            'final_price': final_price,
+            'item_total': item_total
+        })
+    return items, total
+
+# корзина гостя живет в его сессии (данные сессии на сервере, см. ServerSessionInterface): {id книги: количество}.
+# в БД гость ничего не пишет и ничего не бронирует; при входе корзина переносится в Cart одним upsert
+def get_guest_cart():
+    return dict(session.get('cart', {}))
+
+def save_guest_cart(items):
+    if items:
+        session['cart'] = items
+    else:
+        session.pop('cart', None)
+
+def get_priced_guest_cart(items):
+    if not items:
+        return [], Decimal('0.00')
+    books = Book.query.filter(Book.id.in_(list(items))).options(
+        joinedload(Book.product, innerjoin=True), selectinload(Book.authors)).order_by(Book.id).all()
+    return price_cart_items([(book.product, items[book.id], None) for book in books])
+
+# корзина пользователя создается при первой покупке, а не при регистрации; id нужен сразу для броней
+def get_or_create_cart(user_id):
+    cart = Cart.query.filter_by(user_id=user_id).first()
+    if not cart:
+        cart = Cart(user_id=user_id)
+        db.session.add(cart)
+        db.session.flush()
+    return cart
+
+# переносит корзину гостя в корзину пользователя: количества одинаковых книг складываются.
+# перенесенные позиции не бронируются - как позиции с истекшей бронью, остаток проверит оформление заказа.
+# коммит на вызывающем
+def merge_guest_cart(user_id, items):
+    book_ids = db.session.execute(select(Book.id).where(Book.id.in_(list(items)))).scalars().all()
+    if not book_ids:
+        return
+    cart = get_or_create_cart(user_id)
+    upsert(CartItem.__table__, [{'cart_id': cart.id, 'product_id': book_id, 'quantity': items[book_id]}
+                                for book_id in sorted(book_ids)], ['cart_id', 'product_id'], ['quantity'], increment=True)
+
+# товар и авторы нужны каждой карточке книги - грузим их сразу для всей страницы
+def with_card_data(query):
+    return query.options(joinedload(Book.product), selectinload(Book.authors))
+
+# размер страницы из ?per_page, с ограничением сверху
+def get_page_size():
+    per_page = request.args.get('per_page', type=int) or app.config['CATALOG_PAGE_SIZE']
+    return max(1, min(per_page, app.config['CATALOG_MAX_PAGE_SIZE']))
+
+# сортировки каталога: ?sort -> (столбец, по убыванию); без sort - по id
+CATALOG_SORTS = {
+    'price': (Book.final_price, False),
+    'price_desc': (Book.final_price, True),
+}
+
+# постраничная выборка книг по ключу без OFFSET: (значение сортировки, id) > курсора.
+# курсор следующей страницы - параметры ссылки {'after': id, 'after_value': значение}
+def paginate_books(query, after_id, per_page, sort=None, after_value=None):
+    query = with_card_data(query)
+    if sort in CATALOG_SORTS:
+        column, descending = CATALOG_SORTS[sort]
+        query = query.filter(column.isnot(None))
+        if after_id and after_value is not None:
+            beyond = column < after_value if descending else column > after_value
+            query = query.filter(or_(beyond, (column == after_value) & (Book.id > after_id)))
+        query = query.order_by(column.desc() if descending else column, Book.id)
+    else:
+        if after_id:
+            query = query.filter(Book.id > after_id)
+        query = query.order_by(Book.id)
+    books = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(books) > per_page:
+        books = books[:per_page]
+        next_cursor = {'after': books[-1].id}
+        if sort in CATALOG_SORTS:
+            next_cursor['after_value'] = getattr(books[-1], CATALOG_SORTS[sort][0].key)
+    return books, next_cursor
+
+def parse_decimal(value):
+    try:
+        return Decimal(value) if value else None
+    except InvalidOperation:
+        return None
+
+# меняет бронь корзины на delta экземпляров и продлевает ее.
+# увеличение - условный UPDATE, проходит только если свободных (quantity - reserved_quantity) хватает,
+# поэтому два покупателя не могут забронировать один и тот же экземпляр. коммит на вызывающем.
+# бронь меняет свободный остаток на карточке и странице книги - отмечаем версию книги и наличие, как в consume_stock.
+# версию 'catalog' остатки не трогают, иначе каждая корзина сбрасывала бы кэш главной и каталога:
+# там остаток может отставать на PAGE_ETAG_SECONDS
+def reserve_stock(cart_id, product_id, delta):
+    hold = StockReservation.query.filter_by(cart_id=cart_id, product_id=product_id).with_for_update().first()
+    if delta > 0:
+        updated = Book.query.filter(
+            Book.id == product_id,
+            Book.quantity - Book.reserved_quantity >= delta
+        ).update({Book.reserved_quantity: Book.reserved_quantity + delta}, synchronize_session=False)
+        if not updated:
+            return False
+    else:
+        if not hold:
+            # бронь уже снята по истечении срока
+            return True
+        delta = max(delta, -hold.quantity)
+        Book.query.filter(Book.id == product_id).update(
+            {Book.reserved_quantity: Book.reserved_quantity + delta}, synchronize_session=False)
+    mark_stock_changed(product_id)
+    expires_at = datetime.utcnow() + timedelta(minutes=app.config['STOCK_HOLD_MINUTES'])
+    if not hold:
+        db.session.add(StockReservation(cart_id=cart_id, product_id=product_id, quantity=delta, expires_at=expires_at))
+    elif hold.quantity + delta > 0:
+        hold.quantity += delta
+        hold.expires_at = expires_at
+    else:
+        db.session.delete(hold)
+    return True
+
+# списывает со склада позиции заказа, по одному условному UPDATE на позицию.
+# своя бронь уже учтена в reserved_quantity, поэтому со свободного остатка берется только недостающее.
+# возвращает позицию, которой не хватило (тогда вызывающий откатывает транзакцию), иначе None
+def consume_stock(cart_id, items):
+    holds = {hold.product_id: hold for hold in
+             StockReservation.query.filter_by(cart_id=cart_id).with_for_update().all()}
+    for item in items:
+        product_id = item['product'].id
+        hold = holds.pop(product_id, None)
+        held = hold.quantity if hold else 0
+        updated = Book.query.filter(
+            Book.id == product_id,
+            Book.quantity >= item['quantity'],
+            Book.quantity - Book.reserved_quantity >= item['quantity'] - held
+        ).update({
+            Book.quantity: Book.quantity - item['quantity'],
+            Book.reserved_quantity: Book.reserved_quantity - held
+        }, synchronize_session=False)
+        if not updated:
+            return item
+        mark_stock_changed(product_id)
+        if hold:
+            db.session.delete(hold)
+    # брони на товары, которых в корзине уже нет
+    for hold in holds.values():
+        reserve_stock(cart_id, hold.product_id, -hold.quantity)
+    return None
+
+# снимает истекшие брони пачками; SKIP LOCKED - чтобы несколько воркеров не ждали друг друга
+def release_expired_reservations(batch_size=500):
+    released = 0
+    while True:
+        expired = StockReservation.query.filter(
+            StockReservation.expires_at < datetime.utcnow()
+        ).with_for_update(skip_locked=True).limit(batch_size).all()
+        for hold in expired:
+            Book.query.filter(Book.id == hold.product_id).update(
+                {Book.reserved_quantity: Book.reserved_quantity - hold.quantity}, synchronize_session=False)
+            mark_stock_changed(hold.product_id)
+            db.session.delete(hold)
+        db.session.commit()
+        released += len(expired)
+        if len(expired) < batch_size:
+            return released
+
+# фоновый поток, периодически снимающий истекшие брони
+def run_reservation_sweeper(interval):
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                release_expired_reservations()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception(f"Ошибка при снятии броней: {str(e)}")
+
+@app.before_first_request
+def start_reservation_sweeper():
+    interval = app.config['STOCK_SWEEP_INTERVAL']
+    if interval:
+        threading.Thread(target=run_reservation_sweeper, args=(interval,), daemon=True).start()
+
+@app.cli.command('release-reservations')
+def release_reservations_command():
+    """Снять истекшие брони товаров."""
+    print(f"Снято броней: {release_expired_reservations()}")
+
+# добавляет записи в журнал баланса одним многострочным INSERT
+def add_ledger_entries(entries):
+    if entries:
+        db.session.execute(BalanceLedger.__table__.insert(), entries)
+
+# атомарно меняет баланс на стороне БД и пишет операцию в журнал в той же транзакции.
+# списание проходит только если хватает средств, иначе False. коммит на вызывающем
+def change_balance(user_id, amount, reason, order_id=None):
+    amount = Decimal(amount).quantize(CENTS, rounding=ROUND_HALF_UP)
+    conditions = [Users.id == user_id]
+    if amount < 0:
+        conditions.append(Users.balance >= -amount)
+    updated = Users.query.filter(*conditions).update({
+        Users.balance: Users.balance + amount,
+        Users.balance_version: Users.balance_version + 1
+    }, synchronize_session=False)
+    if not updated:
+        return False
+    version = db.session.query(Users.balance_version).filter_by(id=user_id).scalar()
+    add_ledger_entries([{
+        'user_id': user_id, 'amount': amount, 'reason': reason, 'order_id': order_id,
+        'balance_version': version, 'created_at': datetime.utcnow()
+    }])
+    user_cache.pop(user_id, None)
+    return True
+
+# обновляет снимки балансов пользователей, у которых версия ушла вперед
+def snapshot_balances(batch_size=1000):
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Users.id, Users.balance, Users.balance_version, BalanceSnapshot.user_id.label('snapshot_user_id')
+        ).outerjoin(
+            BalanceSnapshot, BalanceSnapshot.user_id == Users.id
+        ).filter(
+            Users.id > last_id,
+            (BalanceSnapshot.user_id == None) | (BalanceSnapshot.balance_version < Users.balance_version)
+        ).order_by(Users.id).limit(batch_size).all()
+        if not rows:
+            return updated
+        now = datetime.utcnow()
+        snapshots = [{'user_id': r.id, 'balance': r.balance or 0, 'balance_version': r.balance_version, 'created_at': now}
+                     for r in rows]
+        db.session.bulk_insert_mappings(
+            BalanceSnapshot, [snap for snap, r in zip(snapshots, rows) if r.snapshot_user_id is None])
+        db.session.bulk_update_mappings(
+            BalanceSnapshot, [snap for snap, r in zip(snapshots, rows) if r.snapshot_user_id is not None])
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1].id
+
+# пользователи, у которых снимок + журнал после него не сходится с балансом
+def verify_balances():
+    ledger_after = db.session.query(
+        BalanceLedger.user_id, func.sum(BalanceLedger.amount).label('amount')
+    ).join(BalanceSnapshot, BalanceSnapshot.user_id == BalanceLedger.user_id).filter(
+        BalanceLedger.balance_version > BalanceSnapshot.balance_version
+    ).group_by(BalanceLedger.user_id).subquery()
+    return db.session.query(Users.id).join(BalanceSnapshot, BalanceSnapshot.user_id == Users.id).outerjoin(
+        ledger_after, ledger_after.c.user_id == Users.id
+    ).filter(
+        BalanceSnapshot.balance + func.coalesce(ledger_after.c.amount, 0) != Users.balance
+    ).all()
+
+ledger_cli = AppGroup('ledger', help='Журнал баланса.')
+
+@ledger_cli.command('snapshot')
+def ledger_snapshot_command():
+    """Обновить снимки балансов."""
+    print(f"Обновлено снимков: {snapshot_balances()}")
+
+@ledger_cli.command('verify')
+def ledger_verify_command():
+    """Сверить балансы со снимками и журналом."""
+    mismatched = verify_balances()
+    for row in mismatched:
+        print(f"Баланс не сходится с журналом: пользователь #{row.id}")
+    print(f"Расхождений: {len(mismatched)}")
+
+app.cli.add_command(ledger_cli)
+# обработчики задач очереди: вид задачи -> функция(order_id, **payload)
+order_job_handlers = {}
+
+def order_job(kind):
+    def decorator(handler):
+        order_job_handlers[kind] = handler
+        return handler
+    return decorator
+
+# задача в очереди; пишется в той же транзакции, что и изменение заказа, и выполняется воркером после коммита
+def enqueue_job(kind, order_id=None, **payload):
+    db.session.add(OrderJob(kind=kind, order_id=order_id, payload=json.dumps(payload, ensure_ascii=False),
+                            run_at=datetime.utcnow()))
+
+# задачи после смены статуса: уведомление, при отмене - возврат денег и товара
+def order_status_changed(order_id, status):
+    enqueue_job('order_status', order_id, status=status)
+    if status == 'отменен':
+        enqueue_job('order_cancelled', order_id)
+
+# переводит заказ в новый статус, если переход разрешен; коммитит вызывающий
+def advance_order(order_id, status):
+    order = Order.query.filter_by(id=order_id).with_for_update().first()
+    if not order or status not in ORDER_TRANSITIONS.get(order.status, ()):
+        return False
+    order.status = status
+    order_status_changed(order_id, status)
+    return True
+
+# сумма, списанная с баланса за заказ (с учетом возвратов)
+def order_paid_amount(order_id):
+    return -(db.session.query(func.coalesce(func.sum(BalanceLedger.amount), 0)).filter_by(order_id=order_id).scalar())
+
+@order_job('order_placed')
+def handle_order_placed(order_id):
+    order = Order.query.get(order_id)
+    if not order:
+        return
+    # в отчеты заказ попадает при создании, при отмене вычитается обратно. уже отмененный
+    # (в админке, до этой задачи) не прибавляем: задача отмены могла выполниться раньше
+    if order.status != 'отменен':
+        count_order_sales(order_id, 1)
+    if order.status != 'обрабатывается':
+        return
+    # оплата подтверждается записью в журнале баланса, без нее заказ отменяется
+    advance_order(order_id, 'оплачен' if order_paid_amount(order_id) >= order.total_amount else 'отменен')
+    enqueue_job('reconcile_stock', order_id, book_ids=[item.product_id for item in order.items])
+
+@order_job('order_status')
+def notify_order_status(order_id, status):
+    order = Order.query.get(order_id)
+    app.logger.info(f"Уведомление пользователю #{order.user_id}: заказ #{order_id} - {status}")
+
+@order_job('order_cancelled')
+def handle_order_cancelled(order_id):
+    order = Order.query.get(order_id)
+    count_order_sales(order_id, -1)
+    for item in order.items:
+        Book.query.filter(Book.id == item.product_id).update(
+            {Book.quantity: Book.quantity + item.quantity}, synchronize_session=False)
+        mark_cache_changed('catalog')
+        mark_stock_changed(item.product_id)
+    paid = order_paid_amount(order_id)
+    if paid > 0:
+        change_balance(order.user_id, paid, 'возврат за заказ', order_id)
+
+# итоги продаж заказов по дням: строки для sales_daily. жанр и авторы берутся текущие, а не на момент заказа
+def order_sales(order_ids):
+    items = db.session.execute(
+        select(Order.id, Order.order_date, OrderItem.product_id, OrderItem.quantity, OrderItem.price_at_purchase, Book.genre)
+        .join(OrderItem, OrderItem.order_id == Order.id).outerjoin(Book, Book.id == OrderItem.product_id)
+        .where(Order.id.in_(order_ids))
+    ).all()
+    authors = {}
+    for link in db.session.execute(select(book_author.c.book_id, book_author.c.author_id).where(
+            book_author.c.book_id.in_({item.product_id for item in items}))):
+        authors.setdefault(link.book_id, []).append(link.author_id)
+    # (dimension, день, ключ) -> [id заказов, штук, выручка]
+    totals = {}
+    for item in items:
+        day = item.order_date.date()
+        revenue = Decimal(item.price_at_purchase or 0) * item.quantity
+        keys = [('total', ''), ('book', str(item.product_id))]
+        if item.genre:
+            keys.append(('genre', item.genre))
+        keys.extend(('author', str(author_id)) for author_id in authors.get(item.product_id, ()))
+        for dimension, key in keys:
+            row = totals.setdefault((dimension, day, key), [set(), 0, Decimal('0.00')])
+            row[0].add(item.id)
+            row[1] += item.quantity
+            row[2] += revenue
+    return [{'dimension': dimension, 'day': day, 'dimension_key': key,
+             'orders': len(row[0]), 'units': row[1], 'revenue': row[2]}
+            for (dimension, day, key), row in totals.items()]
+
+# учитывает заказ в sales_daily (sign=-1 - убирает), если он еще не учтен (уже учтен).
+# флаг меняется условным UPDATE: повтор задачи, отмена до order_placed и flask reports rebuild
+# между ними не учтут заказ дважды
+def count_order_sales(order_id, sign):
+    updated = Order.query.filter(Order.id == order_id, Order.counted_in_sales == (sign < 0)).update(
+        {Order.counted_in_sales: sign > 0}, synchronize_session=False)
+    if updated:
+        increment_sales(order_sales([order_id]), sign)
+
+# прибавляет (sign=-1 - вычитает) строки к sales_daily одним upsert.
+# строки в порядке ключа, чтобы параллельные задачи блокировали их в одном порядке и не ловили deadlock
+def increment_sales(rows, sign=1):
+    if not rows:
+        return
+    rows = sorted(({**row, 'orders': sign * row['orders'], 'units': sign * row['units'], 'revenue': sign * row['revenue']}
+                   for row in rows), key=itemgetter('dimension', 'day', 'dimension_key'))
+    upsert(SalesDaily.__table__, rows, ['dimension', 'day', 'dimension_key'], ['orders', 'units', 'revenue'],
+           increment=True)
+
+# пересчет sales_daily с нуля пачками заказов - по заказам с флагом counted_in_sales,
+# который ставят и снимают задачи order_placed и order_cancelled
+def rebuild_sales(batch_size):
+    SalesDaily.query.delete()
+    counted = Order.counted_in_sales.is_(True)
+    last_id = 0
+    total = 0
+    while True:
+        order_ids = db.session.execute(
+            select(Order.id).where(Order.id > last_id, counted).order_by(Order.id).limit(batch_size)
+        ).scalars().all()
+        if not order_ids:
+            db.session.commit()
+            return total
+        increment_sales(order_sales(order_ids))
+        db.session.commit()
+        total += len(order_ids)
+        last_id = order_ids[-1]
+
+# пересчитывает reserved_quantity книг по действующим броням - исправляет расхождения счетчика
+@order_job('reconcile_stock')
+def reconcile_stock(order_id, book_ids):
+    held = select(func.coalesce(func.sum(StockReservation.quantity), 0)).where(
+        StockReservation.product_id == Book.id).scalar_subquery()
+    Book.query.filter(Book.id.in_(book_ids), Book.reserved_quantity != held).update(
+        {Book.reserved_quantity: held}, synchronize_session=False)
+
+# забирает готовые задачи: run_at сдвигается на срок аренды, так что задачи упавшего воркера
+# вернутся в работу сами. SKIP LOCKED - чтобы воркеры не ждали друг друга
+def claim_jobs(limit):
+    now = datetime.utcnow()
+    jobs = OrderJob.query.filter(OrderJob.status == 'pending', OrderJob.run_at <= now).order_by(
+        OrderJob.run_at).with_for_update(skip_locked=True).limit(limit).all()
+    for job in jobs:
+        job.attempts += 1
+        job.run_at = now + timedelta(seconds=app.config['ORDER_JOB_LEASE_SECONDS'])
+    db.session.commit()
+    return [job.id for job in jobs]
+
+# выполняет задачу: работа обработчика и отметка о выполнении коммитятся вместе
+def run_job(job_id):
+    job = OrderJob.query.get(job_id)
+    try:
+        order_job_handlers[job.kind](job.order_id, **json.loads(job.payload or '{}'))
+        job.status = 'done'
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception(f"Ошибка задачи #{job_id}: {str(e)}")
+        job = OrderJob.query.get(job_id)
+        if job.attempts >= app.config['ORDER_JOB_MAX_ATTEMPTS']:
+            job.status = 'failed'
+        else:
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=app.config['ORDER_JOB_RETRY_SECONDS'] * 2 ** (job.attempts - 1))
+        job.last_error = str(e)[:1000]
+        db.session.commit()
+
+def run_job_in_context(job_id):
+    with app.app_context():
+        run_job(job_id)
+
+# воркер очереди заказов: забирает пачку задач и выполняет в пуле потоков
+def run_order_worker(threads, poll, once=False):
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            with app.app_context():
+                try:
+                    job_ids = claim_jobs(threads * 2)
+                except (OperationalError, ProgrammingError) as e:
+                    # например, миграции еще не применены
+                    db.session.rollback()
+                    app.logger.exception(f"Ошибка при получении задач: {str(e)}")
+                    job_ids = []
+            if job_ids:
+                list(pool.map(run_job_in_context, job_ids))
+            elif once:
+                return
+            else:
+                refresh_recommendations()
+                prune_page_cache()
+                time.sleep(poll)
+
+# в простое воркер дописывает новые заказы в рекомендации, не чаще раза в RECOMMENDATIONS_REFRESH_SECONDS
+recommendations_refreshed_at = [0.0]
+
+def refresh_recommendations():
+    interval = app.config['RECOMMENDATIONS_REFRESH_SECONDS']
+    if not interval or time.monotonic() - recommendations_refreshed_at[0] < interval:
+        return
+    recommendations_refreshed_at[0] = time.monotonic()
+    with app.app_context():
+        try:
+            counted, _ = build_recommendations()
+        except (OperationalError, ProgrammingError, OSError) as e:
+            db.session.rollback()
+            app.logger.exception(f"Ошибка при пересчете рекомендаций: {str(e)}")
+            return
+    if counted:
+        app.logger.info('Рекомендации: учтено новых заказов %s', counted)
+
+# файловый кэш страниц общий с web, истекшие страницы из него воркер удаляет в простое раз в PAGE_CACHE_TTL
+page_cache_pruned_at = [time.monotonic()]
+
+def prune_page_cache():
+    interval = app.config['PAGE_CACHE_TTL']
+    if app.config['PAGE_CACHE_BACKEND'] != 'file' or not interval or \
+            time.monotonic() - page_cache_pruned_at[0] < interval:
+        return
+    page_cache_pruned_at[0] = time.monotonic()
+    try:
+        page_cache.prune()
+    except OSError as e:
+        app.logger.exception(f"Ошибка при очистке кэша страниц: {str(e)}")
+
+orders_cli = AppGroup('orders', help='Очередь обработки заказов.')
+
+@orders_cli.command('worker')
+@click.option('--threads', type=int, help='Потоков (по умолчанию ORDER_WORKER_THREADS).')
+@click.option('--once', is_flag=True, help='Выполнить накопившиеся задачи и выйти.')
+def orders_worker_command(threads, once):
+    """Выполнять задачи заказов: смена статусов, уведомления, возвраты, сверка остатков."""
+    wait_for_db()
+    # уведомления пишутся в лог на уровне INFO
+    app.logger.setLevel(logging.INFO)
+    run_order_worker(threads or app.config['ORDER_WORKER_THREADS'], app.config['ORDER_WORKER_POLL'], once)
+
+@orders_cli.command('set-status')
+@click.argument('order_id', type=int)
+@click.argument('status', type=click.Choice(ORDER_STATUSES))
+def orders_set_status_command(order_id, status):
+    """Перевести заказ в новый статус (только по разрешенным переходам)."""
+    if not advance_order(order_id, status):
+        db.session.rollback()
+        print(f"Заказ #{order_id} нельзя перевести в статус '{status}'")
+        sys.exit(1)
+    db.session.commit()
+    print(f"Заказ #{order_id}: {status}")
+
+app.cli.add_command(orders_cli)
+
+reports_cli = AppGroup('reports', help='Отчеты по продажам.')
+
+@reports_cli.command('rebuild')
+@click.option('--batch', default=1000, help='Заказов за один запрос.')
+def reports_rebuild_command(batch):
+    """Пересчитать дневные итоги продаж по всем заказам (после обновления или ручной правки заказов)."""
+    print(f"Учтено заказов: {rebuild_sales(batch)}")
+
+app.cli.add_command(reports_cli)
+
+# кэш в памяти процесса: вытесняет давно неиспользуемые записи, у каждой записи срок жизни.
+# версии сущностей хранятся отдельно и не вытесняются, иначе счетчик сбросится и вернет старые страницы.
+# версии тоже свои у каждого процесса: изменения из другого воркера gunicorn или из flask-команды
+# до этого кэша не доходят, и он отдает старые страницы до истечения PAGE_CACHE_TTL
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.versions = {}
+        self.modified = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.data.pop(key, None)
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_version(self, key):
+        return self.versions.get(key, 0)
+
+    def incr_version(self, key):
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            self.modified[key] = time.time()
+
+    # когда версия менялась последний раз (unix time, 0 - не менялась)
+    def get_modified(self, key):
+        return self.modified.get(key, 0)
+
+    def stats(self):
+        return {'backend': 'memory', 'hits': self.hits, 'misses': self.misses, 'size': len(self.data)}
+
+    def prune(self):
+        with self.lock:
+            expired = [key for key, item in self.data.items() if item[0] < time.monotonic()]
+            for key in expired:
+                del self.data[key]
+        return len(expired)
+
+# кэш в файлах - общий для всех воркеров на одной машине.
+# запись через временный файл и os.replace, чтобы читатели не видели файл наполовину
+class FileCache:
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+    def _write(self, key, value):
+        tmp = f'{self._file(key)}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp, self._file(key))
+
+    def _read(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+
+    def get(self, key):
+        item = self._read(key)
+        if item is None or item[0] < time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._write(key, (time.time() + self.ttl, value))
+
+    def get_version(self, key):
+        return self._read('version:' + key) or 0
+
+    def incr_version(self, key):
+        # гонка двух воркеров может потерять одно увеличение, но версия все равно сменится
+        self._write('version:' + key, self.get_version(key) + 1)
+
+    def get_modified(self, key):
+        try:
+            return os.path.getmtime(self._file('version:' + key))
+        except OSError:
+            return 0
+
+    def stats(self):
+        return {'backend': 'file', 'hits': self.hits, 'misses': self.misses}
+
+    # сами файлы с истекшим сроком не удаляются - их чистит prune (flask cache prune по cron).
+    # версии (просто число) не трогаем
+    def prune(self):
+        removed = 0
+        for entry in os.scandir(self.path):
+            try:
+                with open(entry.path, 'rb') as f:
+                    expires = pickle.load(f)[0]
+            except (OSError, EOFError, pickle.PickleError, TypeError, IndexError):
+                continue
+            if expires < time.time():
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+if app.config['PAGE_CACHE_BACKEND'] == 'file':
+    page_cache = FileCache(app.config['PAGE_CACHE_DIR'], app.config['PAGE_CACHE_TTL'])
+else:
+    page_cache = LRUCache(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'])
+
+cache_cli = AppGroup('cache', help='Кэш страниц.')
+
+@cache_cli.command('prune')
+def cache_prune_command():
+    """Удалить истекшие страницы из файлового кэша (запускать по cron)."""
+    if app.config['PAGE_CACHE_BACKEND'] != 'file':
+        print("Кэш в памяти у каждого процесса свой и ограничен PAGE_CACHE_SIZE, чистить нечего")
+        return
+    print(f"Удалено записей: {page_cache.prune()}")
+
+app.cli.add_command(cache_cli)
+
+# хранилища серверных сессий: load(key) -> (срок, значение) или None, save(key, значение, срок), delete(key).
+# в памяти - только для одного процесса (разработка), в файлах - общее для всех воркеров на одной машине
+class MemorySessionStore:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[0] < time.time():
+                self.data.pop(key, None)
+                return None
+            self.data.move_to_end(key)
+            return item
+
+    def save(self, key, value, expires):
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def prune(self):
+        with self.lock:
+            expired = [key for key, item in self.data.items() if item[0] < time.time()]
+            for key in expired:
+                del self.data[key]
+        return len(expired)
+
+class FileSessionStore(FileCache):
+    def __init__(self, path):
+        super().__init__(path, 0)
+
+    def load(self, key):
+        item = self._read(key)
+        return item if item is not None and item[0] >= time.time() else None
+
+    def save(self, key, value, expires):
+        self._write(key, (expires, value))
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+# сессия, данные которой лежат на сервере; в cookie только случайный id
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires=0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.stale_sid = None
+        self.modified = False
+
+    # новый id при входе и выходе: id, известный до входа, не должен стать id залогиненной сессии
+    def regenerate(self):
+        self.stale_sid = self.stale_sid or self.sid
+        self.sid = None
+        self.modified = True
+
+# срок жизни сессии продлевается при использовании, но запись перезаписываем не чаще, чем раз в половину срока.
+# отзыв - метка revoked:<user_id> со временем: сессии, начатые раньше нее, считаются пустыми
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store, lifetime):
+        self.store = store
+        self.lifetime = lifetime
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        item = self.store.load('session:' + sid) if sid else None
+        if item is None:
+            return ServerSession()
+        expires, data = item
+        user_id = data.get('user_id')
+        revoked = self.store.load(f'revoked:{user_id}') if user_id else None
+        if revoked and revoked[1] >= data.get('_login_at', 0):
+            self.store.delete('session:' + sid)
+            return ServerSession()
+        return ServerSession(data, sid, expires)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.stale_sid:
+            self.store.delete('session:' + session.stale_sid)
+        if not session:
+            if session.sid:
+                self.store.delete('session:' + session.sid)
+            if session.sid or session.stale_sid:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        now = time.time()
+        if not session.modified and session.expires - now > self.lifetime / 2:
+            return
+        is_new = session.sid is None
+        if is_new:
+            session.sid = secrets.token_urlsafe(32)
+        self.store.save('session:' + session.sid, dict(session), now + self.lifetime)
+        if is_new:
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+if app.config['SESSION_BACKEND'] == 'memory':
+    session_store = MemorySessionStore(app.config['SESSION_MEMORY_SIZE'])
+else:
+    session_store = FileSessionStore(app.config['SESSION_DIR'])
+app.session_interface = ServerSessionInterface(session_store, app.config['SESSION_LIFETIME'])
+
+# разлогинивает пользователя во всех браузерах
+def revoke_user_sessions(user_id):
+    session_store.save(f'revoked:{user_id}', time.time(), time.time() + app.config['SESSION_LIFETIME'])
+
+sessions_cli = AppGroup('sessions', help='Сессии пользователей.')
+
+@sessions_cli.command('revoke')
+@click.argument('username')
+def sessions_revoke_command(username):
+    """Разлогинить пользователя во всех браузерах."""
+    user = Users.query.filter_by(username=username).first()
+    if not user:
+        print(f"Пользователь {username} не найден")
+        sys.exit(1)
+    revoke_user_sessions(user.id)
+    print(f"Сессии пользователя {username} отозваны")
+
+@sessions_cli.command('prune')
+def sessions_prune_command():
+    """Удалить истекшие сессии и метки отзыва (для файлового хранилища - запускать по cron)."""
+    print(f"Удалено записей: {session_store.prune()}")
+
+app.cli.add_command(sessions_cli)
+
+# помечает версии, которые нужно сменить после коммита текущей транзакции
+def mark_cache_changed(*keys):
+    db.session.info.setdefault('cache_versions', set()).update(keys)
+
+# ключи версий, которые затрагивает изменение объекта: страница книги показывает авторов,
+# страница автора - книги с ценами, а каталог и главная - все сразу.
+# связи читаем запросом по book_author, а не через relationship, чтобы не грузить коллекции во время flush
+def cache_keys_for(connection, obj):
+    if isinstance(obj, (Book, Product)):
+        keys = {f'book:{obj.id}'}
+        rows = connection.execute(select(book_author.c.author_id).where(book_author.c.book_id == obj.id))
+        keys.update(f'author:{row.author_id}' for row in rows)
+    elif isinstance(obj, Author):
+        keys = {f'author:{obj.id}'}
+        rows = connection.execute(select(book_author.c.book_id).where(book_author.c.author_id == obj.id))
+        keys.update(f'book:{row.book_id}' for row in rows)
+    else:
+        return set()
+    keys.add('catalog')
+    return keys
+
+# до flush - старые связи измененных и удаляемых объектов
+@event.listens_for(db.session, 'before_flush')
+def collect_cache_versions_before(session, flush_context, instances):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Book, Product, Author)) and obj.id is not None:
+            session.info.setdefault('cache_versions', set()).update(cache_keys_for(session.connection(), obj))
+
+# после flush - новые объекты и новые связи
+@event.listens_for(db.session, 'after_flush')
+def collect_cache_versions_after(session, flush_context):
+    for obj in list(session.new) + list(session.dirty):
+        session.info.setdefault('cache_versions', set()).update(cache_keys_for(session.connection(), obj))
+
+# версии меняем только после коммита, чтобы не закэшировать страницу с незакоммиченными данными
+@event.listens_for(db.session, 'after_commit')
+def bump_cache_versions(session):
+    for key in session.info.pop('cache_versions', ()):
+        page_cache.incr_version(key)
+
+@event.listens_for(db.session, 'after_rollback')
+def drop_cache_versions(session):
+    session.info.pop('cache_versions', None)
+
+# сжатие ответов: типы, которые имеет смысл сжимать, и кодировка по Accept-Encoding (br, если есть пакет Brotli)
+COMPRESS_MIMETYPES = {'text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript'}
+
+def accepted_encoding():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    # mtime=0 - одинаковое содержимое дает одинаковые байты
+    return gzip.compress(data, compresslevel=app.config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+# страница в кэше: тело и его сжатые варианты (сжимаем один раз, а не на каждый ответ)
+def make_cached_page(body):
+    data = body.encode()
+    encodings = ['gzip'] + (['br'] if brotli is not None else [])
+    return {
+        'body': data,
+        'encoded': {encoding: compress(data, encoding) for encoding in encodings}
+        if len(data) >= app.config['COMPRESS_MIN_SIZE'] else {},
+    }
+
+# выпуск кода для ETag: после деплоя с новыми шаблонами браузеры не должны держать старую разметку
+PAGE_ETAG_SEED = hashlib.sha1(repr(sorted(
+    (entry.name, entry.stat().st_mtime) for entry in os.scandir(os.path.join(app.root_path, 'templates'))
+) + [os.path.getmtime(__file__)]).encode()).hexdigest()
+
+# заголовки проверки для страницы гостя; no-cache - браузер хранит страницу, но каждый раз сверяет ETag,
+# Vary: Cookie - у вошедших страница своя
+def set_page_validators(response, etag, modified):
+    response.set_etag(etag, weak=True)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+# ответ из кэшированной страницы в нужной клиенту кодировке
+def cached_page_response(page):
+    response = make_response(page['body'])
+    if page['encoded']:
+        response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    if encoding in page['encoded']:
+        response.set_data(page['encoded'][encoding])
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+# кэширует страницу целиком для гостей; versions(**view_args) - ключи версий, от которых зависит страница.
+# в ключ попадают только параметры params, которые читает сама страница, в одном порядке:
+# метки вроде ?utm_source и перестановка параметров не плодят копии страницы.
+# ETag - хэш того же ключа, Last-Modified - время последней смены его версий, поэтому If-None-Match и
+# If-Modified-Since дают 304 до поиска в кэше, запросов к БД и рендера (и при PAGE_CACHE_TTL=0).
+# остатки на карточках меняют только версию книги, поэтому ключ еще и сменяется раз в PAGE_ETAG_SECONDS.
+# залогиненные пользователи и страницы с flash-сообщениями всегда рендерятся заново
+def cache_page(versions, params=()):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if 'user_id' in session or session.get('_flashes'):
+                return view(**kwargs)
+            query = urlencode(sorted((name, value) for name in params for value in request.args.getlist(name)))
+            keys = versions(**kwargs)
+            period = app.config['PAGE_ETAG_SECONDS']
+            started = int(time.time() // period * period)
+            key = 'html:' + request.path + '?' + query + ':' + ':'.join(
+                f'{version}={page_cache.get_version(version)}' for version in keys) + f':{started}'
+            etag = hashlib.sha1((PAGE_ETAG_SEED + key).encode()).hexdigest()
+            modified = datetime.utcfromtimestamp(max([started] + [page_cache.get_modified(version) for version in keys]))
+            if not is_resource_modified(request.environ, etag, last_modified=modified):
+                return set_page_validators(make_response('', 304), etag, modified)
+            if not app.config['PAGE_CACHE_TTL']:
+                return set_page_validators(make_response(view(**kwargs)), etag, modified)
+            page = page_cache.get(key)
+            if page is None:
+                page = make_cached_page(view(**kwargs))
+                page_cache.set(key, page)
+            return set_page_validators(cached_page_response(page), etag, modified)
+        return wrapper
+    return decorator
+
+# карточка книги в каталоге, кэшируется по версии книги для всех пользователей.
+# рендерим шаблон напрямую, без контекстных процессоров - карточке пользователь не нужен
+def render_book_card(book):
+    key = f'card:{book.id}:{page_cache.get_version(f"book:{book.id}")}'
+    html = page_cache.get(key)
+    if html is None:
+        html = app.jinja_env.get_template('_book_card.html').render(
+            book=book,
+            get_book_cover=get_book_cover,
+            get_book_price_with_discount=get_book_price_with_discount
+        )
+        page_cache.set(key, html)
+    return Markup(html)
+
+@app.route('/cache_stats')
+def cache_stats():
+    if not is_admin():
+        return redirect(url_for('login'))
+    return jsonify(page_cache.stats())
+
+# метрики запросов на процесс, по endpoint. у каждого воркера gunicorn свои
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+request_metrics = {}
+metrics_lock = threading.Lock()
+
+# время каждого SQL-запроса; в запросе Flask складываем в g.request_stats
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if has_request_context() and 'request_stats' in g:
+        stats = g.request_stats
+        stats['queries'] += 1
+        stats['db_time'] += elapsed
+        stats['statements'][statement] = stats['statements'].get(statement, 0) + 1
+
+# шаблон, который замеряет время рендера; вложенные рендеры (карточки) входят во внешний
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs):
+        if not has_request_context() or 'request_stats' not in g:
+            return super().render(*args, **kwargs)
+        stats = g.request_stats
+        stats['template_depth'] += 1
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats['template_depth'] -= 1
+            if not stats['template_depth']:
+                stats['template_time'] += time.perf_counter() - started
+
+app.jinja_env.template_class = TimedTemplate
+
+@app.before_request
+def start_request_stats():
+    g.request_stats = {'started': time.perf_counter(), 'queries': 0, 'db_time': 0.0, 'statements': {},
+                       'template_time': 0.0, 'template_depth': 0}
+    # профилируем только долю запросов, сохраняем профиль, если запрос оказался медленным
+    if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def record_request_stats(response):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+    duration = time.perf_counter() - stats['started']
+    endpoint = request.endpoint or 'unknown'
+    # одинаковый запрос много раз за один HTTP-запрос - почти всегда N+1 из ленивой загрузки
+    repeated = {statement: count for statement, count in stats['statements'].items()
+                if count > app.config['N_PLUS_ONE_THRESHOLD']}
+    for statement, count in repeated.items():
+        app.logger.warning(f"Возможен N+1 в {endpoint}: {count} раз {' '.join(statement.split())[:200]}")
+    with metrics_lock:
+        metrics = request_metrics.setdefault(endpoint, {
+            'count': 0, 'duration': 0.0, 'buckets': [0] * len(REQUEST_BUCKETS), 'queries': 0,
+            'db_time': 0.0, 'template_time': 0.0, 'bytes': 0, 'n_plus_one': 0
+        })
+        metrics['count'] += 1
+        metrics['duration'] += duration
+        for i, bound in enumerate(REQUEST_BUCKETS):
+            if duration <= bound:
+                metrics['buckets'][i] += 1
+        metrics['queries'] += stats['queries']
+        metrics['db_time'] += stats['db_time']
+        metrics['template_time'] += stats['template_time']
+        metrics['bytes'] += response.content_length or 0
+        metrics['n_plus_one'] += len(repeated)
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable()
+        if duration * 1000 >= app.config['PROFILE_THRESHOLD_MS']:
+            os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+            filename = f"{endpoint}-{datetime.utcnow():%Y%m%d-%H%M%S-%f}.prof"
+            profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], filename))
+            app.logger.warning(f"Медленный запрос {request.path}: {duration * 1000:.0f} мс, профиль {filename}")
+    return response
+
+# сжимает остальные крупные текстовые ответы (страницы вошедших, JSON, метрики).
+# регистрируется после record_request_stats, поэтому выполняется раньше него: в метрики идет размер после сжатия
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    data = response.get_data()
+    if encoding and len(data) >= app.config['COMPRESS_MIN_SIZE']:
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+# метрики в текстовом формате Prometheus
+def render_metrics():
+    lines = []
+    def metric(name, kind, help_text, values):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(values)
+    with metrics_lock:
+        snapshot = {endpoint: dict(values, buckets=list(values['buckets']))
+                    for endpoint, values in request_metrics.items()}
+    histogram = []
+    for endpoint, values in sorted(snapshot.items()):
+        for bound, count in zip(REQUEST_BUCKETS, values['buckets']):
+            histogram.append(f'bookstore_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+        histogram.append(f'bookstore_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {values["count"]}')
+        histogram.append(f'bookstore_request_duration_seconds_sum{{endpoint="{endpoint}"}} {values["duration"]:.6f}')
+        histogram.append(f'bookstore_request_duration_seconds_count{{endpoint="{endpoint}"}} {values["count"]}')
+    metric('bookstore_request_duration_seconds', 'histogram', 'Время обработки запроса.', histogram)
+    for key, name, help_text in [
+        ('queries', 'bookstore_db_queries_total', 'SQL-запросов.'),
+        ('db_time', 'bookstore_db_duration_seconds_total', 'Время в SQL-запросах.'),
+        ('template_time', 'bookstore_template_duration_seconds_total', 'Время рендера шаблонов.'),
+        ('bytes', 'bookstore_response_bytes_total', 'Размер ответов.'),
+        ('n_plus_one', 'bookstore_n_plus_one_total', 'Повторов одного SQL-запроса больше N_PLUS_ONE_THRESHOLD.'),
+    ]:
+        metric(name, 'counter', help_text,
+               [f'{name}{{endpoint="{endpoint}"}} {values[key]}' for endpoint, values in sorted(snapshot.items())])
+    cache = page_cache.stats()
+    metric('bookstore_page_cache_hits_total', 'counter', 'Попаданий в кэш страниц.', [f'bookstore_page_cache_hits_total {cache["hits"]}'])
+    metric('bookstore_page_cache_misses_total', 'counter', 'Промахов кэша страниц.', [f'bookstore_page_cache_misses_total {cache["misses"]}'])
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    if not is_admin():
+        return redirect(url_for('login'))
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# окончания для упрощенного стемминга русских слов (от длинных к коротким)
+RU_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ией', 'иях', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ой', 'ей', 'ий', 'ый',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев',
+    'ию', 'ия', 'ье', 'ья', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й'
+], key=len, reverse=True)
+
+# разбивает запрос на слова и обрезает русские окончания:
+# "преступлением" и "преступление" дают одну основу "преступлени"
+def search_terms(search_query):
+    terms = []
+    for word in re.findall(r'\w+', search_query.lower().replace('ё', 'е')):
+        if re.search('[а-я]', word):
+            for ending in RU_ENDINGS:
+                if word.endswith(ending) and len(word) - len(ending) >= 3:
+                    word = word[:-len(ending)]
+                    break
+        if len(word) >= 2 and word not in terms:
+            terms.append(word)
+    return terms
+
+# поиск по FULLTEXT-индексам книги и авторов одним запросом с ранжированием
+def search_books(search_query, page, per_page, in_stock=False):
+    terms = search_terms(search_query)
+    if not terms:
+        return [], False
+    query = search_books_query(terms)
+    if in_stock:
+        query = query.filter(Book.available_quantity > 0)
+    books = with_card_data(query).offset((page - 1) * per_page).limit(per_page + 1).all()
+    return books[:per_page], len(books) > per_page
+
+def search_books_query(terms):
+    if db.engine.dialect.name == 'mysql':
+        # основа слова + * - поиск по префиксу в boolean mode
+        against = ' '.join(f'{term}*' for term in terms)
+        book_match = match(Book.title, Book.genre, Book.description, against=against).in_boolean_mode()
+        author_match = match(Author.first_name, Author.last_name, Author.middle_name, against=against).in_boolean_mode()
+        # FULLTEXT-индекс используется, только если MATCH стоит в WHERE отдельным условием,
+        # поэтому отбираем по двум MATCH через OR, а сумму оценок считаем только для сортировки найденного
+        author_books = select(book_author.c.book_id).join(Author, Author.id == book_author.c.author_id).where(author_match)
+        author_score = db.session.query(func.coalesce(func.max(author_match), 0)).join(book_author).filter(
+            book_author.c.book_id == Book.id).scalar_subquery()
+        return Book.query.filter(or_(book_match, Book.id.in_(author_books))).order_by(
+            (book_match + author_score).desc(), Book.id)
+    # для других СУБД (sqlite в разработке) - LIKE по основам слов без ранжирования
+    conditions = []
+    for term in terms:
+        pattern = f'%{term}%'
+        conditions.append(Book.title.ilike(pattern) | Book.genre.ilike(pattern) |
+                          Book.description.ilike(pattern) | Book.authors.any(
+                              Author.first_name.ilike(pattern) | Author.last_name.ilike(pattern) |
+                              Author.middle_name.ilike(pattern)))
+    return Book.query.filter(or_(*conditions)).order_by(Book.id)
+
+# пул книг для главной: id книг в наличии и с обложкой, для взвешенного режима - накопленные веса.
+# пересобирается не чаще раза в FEATURED_REFRESH_SECONDS, а не по версии каталога: ее меняет каждый заказ.
+# книги, раскупленные после сборки пула, главная отбрасывает сама
+featured_pool = {'ids': array('l'), 'cum_weights': None, 'loaded_at': 0.0}
+
+def load_featured_pool():
+    rows = db.session.query(Book.id, Product.discount, Book.available_quantity).join(
+        Product, Product.id == Book.id
+    ).filter(Book.available_quantity > 0).order_by(Book.id).all()
+    covers = get_cover_manifest()['files']
+    mode = app.config['FEATURED_WEIGHTING']
+    ids = array('l')
+    weights = []
+    for book_id, discount, in_stock in rows:
+        if book_id not in covers:
+            continue
+        ids.append(book_id)
+        # discount - чем больше скидка, тем чаще книга на главной; stock - чем больше остаток
+        if mode == 'discount':
+            weights.append(1 + float(discount or 0))
+        elif mode == 'stock':
+            weights.append(in_stock)
+    featured_pool.update(ids=ids, cum_weights=list(accumulate(weights)) if weights else None,
+                         loaded_at=time.monotonic())
+
+# случайные id для главной без ORDER BY RAND(): равномерно - O(count), со взвешиванием - бинпоиском
+def sample_featured_ids(count):
+    if time.monotonic() - featured_pool['loaded_at'] > app.config['FEATURED_REFRESH_SECONDS']:
+        load_featured_pool()
+    ids = featured_pool['ids']
+    if len(ids) <= count:
+        return list(ids)
+    if not featured_pool['cum_weights']:
+        return random.sample(ids, count)
+    picked = []
+    for _ in range(count * 20):
+        book_id = random.choices(ids, cum_weights=featured_pool['cum_weights'])[0]
+        if book_id not in picked:
+            picked.append(book_id)
+            if len(picked) == count:
+                return picked
+    # веса слишком неравные - добираем равномерно
+    rest = [book_id for book_id in random.sample(ids, count * 2) if book_id not in picked]
+    return picked + rest[:count - len(picked)]
+
+# фасеты каталога: параметр ссылки -> подпись
+FACETS = [('genre', 'Жанр'), ('publisher', 'Издательство'), ('decade', 'Годы издания'), ('price', 'Цена')]
+# индекс фасетов в памяти процесса: у каждой книги позиция бита, у каждого значения фасета - битовая маска
+# (int) книг с этим значением, ('stock', True) - книги в наличии. счетчик с учетом выбранных фильтров -
+# AND масок и bit_count, без запросов к БД. в своем процессе меняется точечно после коммита,
+# в остальных пересобирается при смене версии 'facets'. версии в кэше в памяти у каждого процесса свои,
+# а остаток меняет каждая корзина без смены версии, поэтому фоновый поток еще и пересобирает индекс
+# раз в FACET_REFRESH_SECONDS: так до воркера доходят правки из других воркеров и flask-команд
+facet_index = {'positions': {}, 'keys': {}, 'bits': {}, 'all': 0, 'size': 0, 'version': None, 'loaded_at': 0.0}
+facet_lock = threading.Lock()
+
+def price_band(price):
+    return bisect_right(app.config['FACET_PRICE_BANDS'], price)
+
+def price_band_label(band):
+    bands = app.config['FACET_PRICE_BANDS']
+    if band == 0:
+        return f'до {bands[0]} ₽'
+    if band == len(bands):
+        return f'от {bands[-1]} ₽'
+    return f'{bands[band - 1]}–{bands[band]} ₽'
+
+def facet_keys(row):
+    keys = []
+    if row.genre:
+        keys.append(('genre', row.genre))
+    if row.publisher:
+        keys.append(('publisher', row.publisher))
+    if row.publish_date:
+        keys.append(('decade', row.publish_date.year // 10 * 10))
+    if row.final_price is not None:
+        keys.append(('price', price_band(row.final_price)))
+    if row.available_quantity > 0:
+        keys.append(('stock', True))
+    return tuple(keys)
+
+def facet_rows(connection, book_ids=None):
+    query = select(Book.id, Book.genre, Book.publisher, Book.publish_date, Book.final_price,
+                   Book.available_quantity).order_by(Book.id)
+    if book_ids is not None:
+        query = query.where(Book.id.in_(list(book_ids)))
+    return connection.execute(query)
+
+# полная сборка: маски собираем в bytearray и переводим в int один раз, а не OR на каждую книгу
+def load_facet_index():
+    version = page_cache.get_version('facets')
+    positions, keys, members = {}, {}, {}
+    for position, row in enumerate(facet_rows(db.session.connection())):
+        positions[row.id] = position
+        keys[row.id] = facet_keys(row)
+        for key in keys[row.id]:
+            members.setdefault(key, []).append(position)
+    size = len(positions)
+    bits = {}
+    for key, member_positions in members.items():
+        mask = bytearray(size // 8 + 1)
+        for position in member_positions:
+            mask[position >> 3] |= 1 << (position & 7)
+        bits[key] = int.from_bytes(mask, 'little')
+    with facet_lock:
+        facet_index.update(positions=positions, keys=keys, bits=bits, all=(1 << size) - 1, size=size, version=version,
+                           loaded_at=time.monotonic())
+
+# точечное обновление масок измененных книг
+def update_facet_index(book_ids):
+    with db.engine.connect() as connection:
+        rows = {row.id: row for row in facet_rows(connection, book_ids)}
+    with facet_lock:
+        bits = facet_index['bits']
+        for book_id in book_ids:
+            position = facet_index['positions'].get(book_id)
+            for key in facet_index['keys'].pop(book_id, ()):
+                bits[key] ^= 1 << position
+            row = rows.get(book_id)
+            if row is None:
+                if position is not None:
+                    facet_index['all'] &= ~(1 << position)
+                continue
+            if position is None:
+                position = facet_index['positions'][book_id] = facet_index['size']
+                facet_index['size'] += 1
+                facet_index['all'] |= 1 << position
+            facet_index['keys'][book_id] = facet_keys(row)
+            for key in facet_index['keys'][book_id]:
+                bits[key] = bits.get(key, 0) | 1 << position
+
+def get_facet_index():
+    if facet_index['version'] != page_cache.get_version('facets'):
+        load_facet_index()
+    return facet_index
+
+# фоновая пересборка индекса, чтобы полный просмотр таблицы не попадал в запрос пользователя
+def run_facet_refresher(interval):
+    while True:
+        time.sleep(interval)
+        if facet_index['version'] is None:
+            continue
+        with app.app_context():
+            try:
+                load_facet_index()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception(f"Ошибка при пересборке фасетов: {str(e)}")
+
+@app.before_first_request
+def start_facet_refresher():
+    interval = app.config['FACET_REFRESH_SECONDS']
+    if interval:
+        threading.Thread(target=run_facet_refresher, args=(interval,), daemon=True).start()
+
+# книги, чьи жанр, издательство, дата или цена изменились; коммит обновит индекс фасетов
+def mark_facets_changed(*book_ids):
+    db.session.info.setdefault('facet_books', set()).update(book_ids)
+    mark_cache_changed('facets')
+
+# остаток книг изменился мимо ORM: версия книги и маска наличия в индексе фасетов после коммита.
+# версию 'facets' не меняем - остатки меняются слишком часто, другие процессы догонят фоновой пересборкой
+def mark_stock_changed(*book_ids):
+    db.session.info.setdefault('stock_books', set()).update(book_ids)
+    mark_cache_changed(*(f'book:{book_id}' for book_id in book_ids))
+
+@event.listens_for(db.session, 'after_flush')
+def collect_facet_changes(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Book, Product)) and obj.id is not None:
+            session.info.setdefault('facet_books', set()).add(obj.id)
+            session.info.setdefault('cache_versions', set()).add('facets')
+
+# версия 'facets' уже увеличена bump_cache_versions (если менялись фасеты, а не только остаток);
+# если индекс был актуален - догоняем его точечно
+@event.listens_for(db.session, 'after_commit')
+def apply_facet_changes(session):
+    facet_books = session.info.pop('facet_books', set())
+    book_ids = facet_books | session.info.pop('stock_books', set())
+    if book_ids and facet_index['version'] is not None:
+        version = page_cache.get_version('facets')
+        if facet_index['version'] + (1 if facet_books else 0) == version:
+            update_facet_index(book_ids)
+            facet_index['version'] = version
+
+@event.listens_for(db.session, 'after_rollback')
+def drop_facet_changes(session):
+    session.info.pop('facet_books', None)
+    session.info.pop('stock_books', None)
+
+# выбранные фильтры из ссылки: фасет -> список значений. десятилетия - только те, что есть в индексе,
+# иначе date() в apply_facet_filters упадет на годе вне 1..9999
+def get_facet_filters():
+    selected = {}
+    for name, _ in FACETS:
+        values = request.args.getlist(name)
+        if name in ('decade', 'price'):
+            values = [int(value) for value in values if value.isdigit()]
+        if name == 'decade' and values:
+            bits = get_facet_index()['bits']
+            values = [value for value in values if ('decade', value) in bits]
+        if values:
+            selected[name] = values
+    return selected
+
+# фильтры фасетов в SQL для самой выдачи; границы те же, что в facet_keys
+def apply_facet_filters(query, selected):
+    if 'genre' in selected:
+        query = query.filter(Book.genre.in_(selected['genre']))
+    if 'publisher' in selected:
+        query = query.filter(Book.publisher.in_(selected['publisher']))
+    if 'decade' in selected:
+        query = query.filter(or_(*(Book.publish_date.between(date(max(decade, 1), 1, 1), date(decade + 9, 12, 31))
+                                   for decade in selected['decade'])))
+    if 'price' in selected:
+        bands = [0] + app.config['FACET_PRICE_BANDS']
+        conditions = []
+        for band in selected['price']:
+            condition = Book.final_price >= bands[min(band, len(bands) - 1)]
+            if band + 1 < len(bands):
+                condition &= Book.final_price < bands[band + 1]
+            conditions.append(condition)
+        query = query.filter(or_(*conditions))
+    return query
+
+# значения фасетов со счетчиками: для каждого фасета учитываются фильтры всех остальных и "в наличии"
+def facet_counts(selected, in_stock=False):
+    index = get_facet_index()
+    bits = index['bits']
+    books = bits.get(('stock', True), 0) if in_stock else index['all']
+    masks = {}
+    for name, values in selected.items():
+        mask = 0
+        for value in values:
+            mask |= bits.get((name, value), 0)
+        masks[name] = mask
+    result = {}
+    for name, _ in FACETS:
+        base = books
+        for other, mask in masks.items():
+            if other != name:
+                base &= mask
+        counts = []
+        for (facet, value), mask in list(bits.items()):
+            if facet == name:
+                count = (base & mask).bit_count()
+                if count or value in selected.get(name, ()):
+                    counts.append((value, count))
+        if name in ('decade', 'price'):
+            counts.sort()
+        else:
+            counts.sort(key=lambda item: (-item[1], item[0]))
+            top = counts[:app.config['FACET_MAX_VALUES']]
+            counts = top + [item for item in counts[len(top):] if item[0] in selected.get(name, ())]
+        result[name] = counts
+    return result
+
+def facet_value_label(name, value):
+    if name == 'decade':
+        return f'{value}-е'
+    if name == 'price':
+        return price_band_label(value)
+    return value
+
+# фасеты для шаблона: у каждого значения ссылка, включающая или снимающая его
+def build_facets(selected, params, in_stock=False):
+    counts = facet_counts(selected, in_stock)
+    facets = []
+    for name, title in FACETS:
+        values = []
+        for value, count in counts[name]:
+            chosen = value in selected.get(name, ())
+            toggled = dict(selected)
+            toggled[name] = [v for v in selected.get(name, []) if v != value] if chosen else \
+                selected.get(name, []) + [value]
+            values.append({'label': facet_value_label(name, value), 'count': count, 'selected': chosen,
+                           'url': url_for('catalog', **params, **toggled)})
+        if values:
+            facets.append({'title': title, 'values': values})
+    return facets
+
+# рекомендации "с этой книгой покупают" строит flask recommendations build (и воркер заказов) в файл RECOMMENDATIONS_PATH:
+# заголовок (сигнатура, K) и для каждого id книги K id соседей int32, 0 - пусто. соседи книги - одно чтение по смещению,
+# файл открывается через mmap, поэтому его страницы в памяти общие для всех воркеров gunicorn
+RECOMMENDATIONS_MAGIC = b'BKR1'
+RECOMMENDATIONS_HEADER = struct.Struct('=4sI')
+# data - (mmap, K), меняется целиком, чтобы потоки не видели mmap нового файла с K старого
+recommendations = {'data': (None, 0), 'mtime': None, 'checked_at': 0.0}
+
+def load_recommendations():
+    path = app.config['RECOMMENDATIONS_PATH']
+    data, mtime = (None, 0), None
+    try:
+        with open(path, 'rb') as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, k = RECOMMENDATIONS_HEADER.unpack_from(mm)
+        if magic == RECOMMENDATIONS_MAGIC and k:
+            data = (mm, k)
+    except (OSError, ValueError, struct.error):
+        # файла еще нет или он пустой - страницы просто без рекомендаций
+        pass
+    # старый mmap не закрываем: его может читать другой поток, освободит сборщик мусора
+    recommendations.update(data=data, mtime=mtime, checked_at=time.monotonic())
+
+# новый файл подхватываем по mtime не чаще раза в RECOMMENDATIONS_CHECK_INTERVAL секунд
+def get_recommendations():
+    if time.monotonic() - recommendations['checked_at'] >= app.config['RECOMMENDATIONS_CHECK_INTERVAL']:
+        try:
+            mtime = os.stat(app.config['RECOMMENDATIONS_PATH']).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != recommendations['mtime']:
+            load_recommendations()
+        else:
+            recommendations['checked_at'] = time.monotonic()
+    return recommendations['data']
+
+# id соседей книги, лучшие первыми
+def recommended_ids(book_id):
+    mm, k = get_recommendations()
+    offset = RECOMMENDATIONS_HEADER.size + book_id * k * 4
+    if mm is None or book_id <= 0 or offset + k * 4 > len(mm):
+        return []
+    return [other for other in struct.unpack_from(f'={k}i', mm, offset) if other]
+
+# рекомендации для одной книги или корзины: сосед выше в списке дает больше очков, у соседей нескольких книг очки складываются.
+# показываем только то, что есть в наличии
+def get_recommended_books(book_ids, limit=None):
+    limit = limit or app.config['RECOMMENDATIONS_SHOWN']
+    scores = {}
+    for book_id in book_ids:
+        neighbours = recommended_ids(book_id)
+        for rank, other in enumerate(neighbours):
+            scores[other] = scores.get(other, 0) + len(neighbours) - rank
+    for book_id in book_ids:
+        scores.pop(book_id, None)
+    if not scores:
+        return []
+    ids = sorted(scores, key=lambda other: (-scores[other], other))
+    books = with_card_data(Book.query.filter(Book.id.in_(ids), Book.available_quantity > 0)).all()
+    books.sort(key=lambda book: ids.index(book.id))
+    return books[:limit]
+
+# статистика для пересчета: pairs[книга][другая книга] - заказов с обеими, sold[книга] - заказов с книгой,
+# last_order_id - последний учтенный заказ. хранится рядом с файлом рекомендаций
+def load_recommendation_state(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.PickleError):
+        return None
+
+# дописывает в статистику заказы после last_order_id пачками по id заказа.
+# свежие заказы пропускаем: заказ с меньшим id может закоммититься позже и иначе был бы пропущен навсегда.
+# отмененные позже заказы остаются в статистике до полного пересчета (--full)
+def count_co_purchases(state, batch_size):
+    pairs, sold = state['pairs'], state['sold']
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['RECOMMENDATIONS_ORDER_DELAY'])
+    max_items = app.config['RECOMMENDATIONS_MAX_ORDER_ITEMS']
+    counted = 0
+    while True:
+        order_ids = db.session.execute(
+            select(Order.id).where(Order.id > state['last_order_id'], Order.order_date < cutoff, Order.status != 'отменен')
+            .order_by(Order.id).limit(batch_size)
+        ).scalars().all()
+        if not order_ids:
+            return counted
+        rows = db.session.execute(
+            select(OrderItem.order_id, OrderItem.product_id)
+            .where(OrderItem.order_id.in_(order_ids)).order_by(OrderItem.order_id, OrderItem.product_id)
+        )
+        for _, items in groupby(rows, key=itemgetter(0)):
+            # пары растут квадратично: у оптовых заказов берем только первые позиции
+            ids = [product_id for _, product_id in items][:max_items]
+            for book_id in ids:
+                sold[book_id] = sold.get(book_id, 0) + 1
+                neighbours = pairs.setdefault(book_id, {})
+                for other in ids:
+                    if other != book_id:
+                        neighbours[other] = neighbours.get(other, 0) + 1
+        counted += len(order_ids)
+        state['last_order_id'] = order_ids[-1]
+
+# топ-K соседей каждой книги: сначала по совместным покупкам, остаток добиваем самыми продаваемыми
+# книгами тех же авторов, затем того же жанра. пишем во временный файл и подменяем через os.replace
+def write_recommendations(state, k, path):
+    pairs, sold = state['pairs'], state['sold']
+    popularity = lambda book_id: (sold.get(book_id, 0), -book_id)
+    books = db.session.execute(select(Book.id, Book.genre)).all()
+    book_ids = {row.id for row in books}
+    by_genre = {}
+    for row in books:
+        by_genre.setdefault(row.genre, []).append(row.id)
+    by_author = {}
+    book_authors = {}
+    for link in db.session.execute(select(book_author.c.book_id, book_author.c.author_id)):
+        by_author.setdefault(link.author_id, []).append(link.book_id)
+        book_authors.setdefault(link.book_id, []).append(link.author_id)
+    # книге нужно не больше K соседей, поэтому от каждой группы хватает K + 1 лучших (одна из них - сама книга)
+    top_genre = {genre: heapq.nlargest(k + 1, ids, key=popularity) for genre, ids in by_genre.items()}
+    top_author = {author_id: heapq.nlargest(k + 1, ids, key=popularity) for author_id, ids in by_author.items()}
+    size = max(book_ids, default=0) + 1
+    table = array('i', bytes(4 * k * size))
+    for row in books:
+        neighbours = pairs.get(row.id, {})
+        chosen = [other for other in heapq.nlargest(k, neighbours, key=lambda other: (neighbours[other], -other))
+                  if other in book_ids]
+        fallbacks = [top_author[author_id] for author_id in book_authors.get(row.id, ())] + [top_genre[row.genre]]
+        for candidates in fallbacks:
+            for other in candidates:
+                if len(chosen) >= k:
+                    break
+                if other != row.id and other not in chosen:
+                    chosen.append(other)
+        table[row.id * k:row.id * k + len(chosen)] = array('i', chosen)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'wb') as f:
+        f.write(RECOMMENDATIONS_HEADER.pack(RECOMMENDATIONS_MAGIC, k))
+        f.write(table.tobytes())
+    os.replace(tmp, path)
+    return len(books)
+
+# пересчет рекомендаций: full - статистика заново по всем заказам, иначе только новые заказы
+def build_recommendations(full=False, batch_size=1000):
+    path = app.config['RECOMMENDATIONS_PATH']
+    state_path = path + '.state'
+    state = (not full and load_recommendation_state(state_path)) or {'pairs': {}, 'sold': {}, 'last_order_id': 0}
+    counted = count_co_purchases(state, batch_size)
+    if counted or full or not os.path.exists(path):
+        written = write_recommendations(state, app.config['RECOMMENDATIONS_K'], path)
+        tmp = f'{state_path}.{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(tmp, state_path)
+        # страницы книг в кэше содержат блок рекомендаций
+        page_cache.incr_version('recommendations')
+    else:
+        written = 0
+    return counted, written
 
 # маршруты
 @app.route('/')
+@cache_page(lambda: ['catalog'])
 def index():
-    books = Book.query.order_by(func.random()).limit(3).all()
-    return render_template('index.html', books=books)
+    # с запасом: часть книг из пула могла закончиться после его сборки
+    ids = sample_featured_ids(6)
+    books = with_card_data(Book.query.filter(Book.id.in_(ids), Book.available_quantity > 0)).all() if ids else []
+    books.sort(key=lambda book: ids.index(book.id))
+    return render_template('index.html', books=books[:3])
 
 @app.route('/catalog')
+@cache_page(lambda: ['catalog'], ['q', 'in_stock', 'sort', 'page', 'per_page', 'after', 'after_value'] +
+            [name for name, _ in FACETS])
 def catalog():
     search_query = request.args.get('q', '').strip()
+    per_page = get_page_size()
+    # только книги, которые можно купить прямо сейчас
+    in_stock = request.args.get('in_stock') == '1'
+    sort = request.args.get('sort') if request.args.get('sort') in CATALOG_SORTS else None
+    params = {'per_page': per_page, 'in_stock': '1' if in_stock else None}
+    facets = None
     if search_query:
-        search_pattern = f'%{search_query}%'
-        books_by_title_or_genre = Book.query.filter(
-            Book.title.ilike(search_pattern) |
-            Book.genre.ilike(search_pattern)
-        ).all()
-        author_books = Book.query.join(Book.authors).filter(
-            Author.first_name.ilike(search_pattern) |
-            Author.last_name.ilike(search_pattern) |
-            Author.middle_name.ilike(search_pattern)
-        ).all()
-        books = list(set(books_by_title_or_genre + author_books))
+        # результаты поиска упорядочены по релевантности, поэтому листаем по номеру страницы
+        page = max(request.args.get('page', 1, type=int), 1)
+        books, has_next = search_books(search_query, page, per_page, in_stock)
+        next_url = url_for('catalog', q=search_query, page=page + 1, **params) if has_next else None
+        first_url = url_for('catalog', q=search_query, **params) if page > 1 else None
     else:
-        books = Book.query.all()
-    return render_template('catalog.html', books=books, search_query=search_query)
+        after_id = request.args.get('after', type=int)
+        # фильтры фасетов - в SQL, счетчики - из индекса в памяти
+        selected = get_facet_filters()
+        facets = build_facets(selected, dict(params, sort=sort), in_stock)
+        params.update(selected)
+        query = Book.query.filter(Book.available_quantity > 0) if in_stock else Book.query
+        books, next_cursor = paginate_books(apply_facet_filters(query, selected), after_id, per_page, sort,
+                                            parse_decimal(request.args.get('after_value')))
+        next_url = url_for('catalog', sort=sort, **params, **next_cursor) if next_cursor else None
+        first_url = url_for('catalog', sort=sort, **params) if after_id else None
+    return render_template('catalog.html', books=books, search_query=search_query, sort=sort, in_stock=in_stock,
+                           facets=facets, next_url=next_url, first_url=first_url)
 
 @app.route('/contacts')
 def contacts():
@@ -287,25 +2426,48 @@ def add_balance():
     if not user:
         return redirect(url_for('login'))
     try:
-        amount = float(request.form.get('amount', 0))
+        amount = Decimal(request.form.get('amount', 0)).quantize(CENTS, rounding=ROUND_HALF_UP)
         if amount > 0:
-            user.balance += amount
+            change_balance(user.id, amount, 'пополнение')
             db.session.commit()
             flash(f'Баланс пополнен на {amount} ₽', 'success')
-    except ValueError:
+    except (InvalidOperation, ValueError):
         flash('Неверная сумма', 'error')
     return redirect(url_for('balance'))
 
 @app.route('/book/<int:book_id>')
+@cache_page(lambda book_id: [f'book:{book_id}', 'recommendations'])
 def book_details(book_id):
     book = Book.query.get_or_404(book_id)
     final_price = get_book_price_with_discount(book)
-    return render_template('book.html', book=book, final_price=final_price)
+    return render_template('book.html', book=book, final_price=final_price,
+                           recommended=get_recommended_books([book.id]))
+
+# сортировки книг на странице автора: ?sort -> (подпись, порядок)
+AUTHOR_BOOK_SORTS = {
+    'new': ('Сначала новые', (Book.publish_date.desc(), Book.id)),
+    'old': ('Сначала старые', (Book.publish_date, Book.id)),
+    'price': ('Сначала дешевле', (Book.final_price, Book.id)),
+    'price_desc': ('Сначала дороже', (Book.final_price.desc(), Book.id)),
+}
 
 @app.route('/author/<int:author_id>')
+@cache_page(lambda author_id: [f'author:{author_id}'], ['sort', 'page', 'per_page'])
 def author_details(author_id):
     author = Author.query.get_or_404(author_id)
-    return render_template('author.html', author=author)
+    sort = request.args.get('sort') if request.args.get('sort') in AUTHOR_BOOK_SORTS else 'new'
+    per_page = get_page_size()
+    # книг у одного автора немного по сравнению с каталогом, поэтому листаем по номеру страницы
+    page = max(request.args.get('page', 1, type=int), 1)
+    books = Book.query.join(book_author, book_author.c.book_id == Book.id).filter(
+        book_author.c.author_id == author_id
+    ).options(joinedload(Book.product)).order_by(*AUTHOR_BOOK_SORTS[sort][1]).offset(
+        (page - 1) * per_page).limit(per_page + 1).all()
+    params = {'author_id': author_id, 'sort': sort, 'per_page': per_page}
+    next_url = url_for('author_details', page=page + 1, **params) if len(books) > per_page else None
+    prev_url = url_for('author_details', page=page - 1, **params) if page > 1 else None
+    return render_template('author.html', author=author, books=books[:per_page], sort=sort,
+                           sorts=AUTHOR_BOOK_SORTS, next_url=next_url, prev_url=prev_url)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -327,9 +2489,6 @@ def register():
         )
         db.session.add(user)
         db.session.commit()
-        cart = Cart(user_id=user.id)
-        db.session.add(cart)
-        db.session.commit()
         flash('Регистрация прошла успешно!', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -341,9 +2500,16 @@ def login():
         password = request.form.get('password', '')
         user = Users.query.filter_by(username=username).first()
         if user and check_password_hash(user.password_hash, password):
+            guest_cart = get_guest_cart()
+            if guest_cart:
+                merge_guest_cart(user.id, guest_cart)
+                db.session.commit()
+            session.clear()
+            session.regenerate()
             session['user_id'] = user.id
             session['username'] = user.username
             session['user_type_id'] = user.user_type_id
+            session['_login_at'] = time.time()
             flash('Вы успешно вошли!', 'success')
             return redirect(url_for('index'))
         else:
@@ -353,76 +2519,86 @@ def login():
 @app.route('/logout')
 def logout():
     session.clear()
+    session.regenerate()
     flash('Вы вышли из системы', 'info')
     return redirect(url_for('index'))
 
 @app.route('/add_to_cart/<int:book_id>')
 def add_to_cart(book_id):
     user = get_current_user()
-    if not user:
-        flash('Войдите в систему', 'error')
-        return redirect(url_for('login'))
     book = Book.query.get(book_id)
     if not book:
         flash('Книга не найдена', 'error')
         return redirect(url_for('catalog'))
-    cart = Cart.query.filter_by(user_id=user.id).first()
-    if not cart:
-        cart = Cart(user_id=user.id)
-        db.session.add(cart)
-        db.session.commit()
+    if not user:
+        return add_to_guest_cart(book)
+    cart = get_or_create_cart(user.id)
     cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=book_id).first()
     if cart_item:
         if cart_item.quantity + 1 > book.quantity:
             flash(f'Нельзя добавить больше {book.quantity} шт. книги "{book.title}"', 'error')
             return redirect(request.referrer or url_for('catalog'))
+    elif book.available_quantity < 1:
+        flash('Эта книга временно отсутствует', 'error')
+        return redirect(request.referrer or url_for('catalog'))
+    if not reserve_stock(cart.id, book_id, 1):
+        db.session.rollback()
+        flash(f'Свободных экземпляров книги "{book.title}" сейчас нет', 'error')
+        return redirect(request.referrer or url_for('catalog'))
+    if cart_item:
         cart_item.quantity += 1
     else:
-        if book.quantity < 1:
-            flash('Эта книга временно отсутствует', 'error')
-            return redirect(request.referrer or url_for('catalog'))
         cart_item = CartItem(cart_id=cart.id, product_id=book_id, quantity=1)
         db.session.add(cart_item)
     db.session.commit()
     flash('Книга добавлена в корзину', 'success')
     return redirect(request.referrer or url_for('catalog'))
 
+# гость: только проверка наличия и запись в сессию
+def add_to_guest_cart(book):
+    items = get_guest_cart()
+    quantity = items.get(book.id, 0) + 1
+    if quantity > book.quantity:
+        flash(f'Нельзя добавить больше {book.quantity} шт. книги "{book.title}"', 'error')
+    elif quantity == 1 and book.available_quantity < 1:
+        flash('Эта книга временно отсутствует', 'error')
+    elif quantity == 1 and len(items) >= app.config['GUEST_CART_MAX_ITEMS']:
+        flash('В корзине слишком много книг. Войдите, чтобы продолжить', 'error')
+    else:
+        items[book.id] = quantity
+        save_guest_cart(items)
+        flash('Книга добавлена в корзину', 'success')
+    return redirect(request.referrer or url_for('catalog'))
+
 @app.route('/cart')
 def cart():
     user = get_current_user()
     if not user:
-        return redirect(url_for('login'))
-    cart = Cart.query.filter_by(user_id=user.id).first()
-    if not cart:
-        cart = Cart(user_id=user.id)
-        db.session.add(cart)
-        db.session.commit()
-        return render_template('cart.html', items=[], total=0)
-    cart_items = CartItem.query.filter_by(cart_id=cart.id).all()
-    total = 0
-    items = []
-    for item in cart_items:
-        product = Product.query.get(item.product_id)
-        if product and product.book:
-            # Используем цену со скидкой
-            final_price = get_book_price_with_discount(product.book)
-            item_total = final_price * item.quantity
-            total += item_total
-            items.append({
-                'book': product.book,
-                'quantity': item.quantity,
-                'total': item_total,
-                'final_price': final_price,
-                'original_price': float(product.price),
-                'discount': float(product.discount or 0)
-            })
-    return render_template('cart.html', items=items, total=total)
+        items, total = get_priced_guest_cart(get_guest_cart())
+    else:
+        cart = Cart.query.filter_by(user_id=user.id).first()
+        items, total = get_priced_cart(cart.id) if cart else ([], 0)
+    recommended = get_recommended_books([item['book'].id for item in items])
+    return render_template('cart.html', items=items, total=total, recommended=recommended)
 
 @app.route('/update_cart/<int:book_id>', methods=['POST'])
 def update_cart(book_id):
     user = get_current_user()
     if not user:
-        return redirect(url_for('login'))
+        items = get_guest_cart()
+        if book_id in items:
+            new_quantity = request.form.get('quantity', 1, type=int)
+            book = Book.query.get(book_id)
+            if book is None or new_quantity < 1:
+                items.pop(book_id)
+                flash('Книга удалена из корзины', 'info')
+            elif new_quantity > book.quantity:
+                flash(f'Нельзя заказать больше {book.quantity} шт. книги "{book.title}"', 'error')
+            else:
+                items[book_id] = new_quantity
+                flash('Количество обновлено', 'success')
+            save_guest_cart(items)
+        return redirect(url_for('cart'))
     cart = Cart.query.filter_by(user_id=user.id).first()
     if not cart:
         return redirect(url_for('cart'))
@@ -433,8 +2609,12 @@ def update_cart(book_id):
         if new_quantity > book.quantity:
             flash(f'Нельзя заказать больше {book.quantity} шт. книги "{book.title}"', 'error')
         elif new_quantity < 1:
+            reserve_stock(cart.id, book_id, -cart_item.quantity)
             db.session.delete(cart_item)
             flash('Книга удалена из корзины', 'info')
+        elif not reserve_stock(cart.id, book_id, new_quantity - cart_item.quantity):
+            db.session.rollback()
+            flash(f'Свободных экземпляров книги "{book.title}" не хватает', 'error')
         else:
             cart_item.quantity = new_quantity
             flash('Количество обновлено', 'success')
@@ -445,11 +2625,16 @@ def update_cart(book_id):
 def remove_from_cart(book_id):
     user = get_current_user()
     if not user:
-        return redirect(url_for('login'))
+        items = get_guest_cart()
+        if items.pop(book_id, None):
+            save_guest_cart(items)
+            flash('Книга удалена из корзины', 'info')
+        return redirect(url_for('cart'))
     cart = Cart.query.filter_by(user_id=user.id).first()
     if cart:
         cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=book_id).first()
         if cart_item:
+            reserve_stock(cart.id, book_id, -cart_item.quantity)
             db.session.delete(cart_item)
             db.session.commit()
             flash('Книга удалена из корзины', 'info')
@@ -459,6 +2644,7 @@ def remove_from_cart(book_id):
 def checkout():
     user = get_current_user()
     if not user:
+        flash('Войдите, чтобы оформить заказ - корзина сохранится', 'info')
         return redirect(url_for('login'))
     payment_address = Address.query.filter_by(user_id=user.id, address_type='payment').first()
     delivery_address = Address.query.filter_by(user_id=user.id, address_type='delivery').first()
@@ -466,33 +2652,16 @@ def checkout():
     if not cart:
         flash('Ваша корзина пуста', 'error')
         return redirect(url_for('cart'))
-    cart_items = CartItem.query.filter_by(cart_id=cart.id).all()
-    if not cart_items:
+    items_with_prices, total = get_priced_cart(cart.id)
+    if not items_with_prices:
         flash('Ваша корзина пуста', 'error')
         return redirect(url_for('cart'))
-    for item in cart_items:
-        if item.product.book.quantity < item.quantity:
+    for item in items_with_prices:
+        if item['book'].quantity < item['quantity']:
             flash(
-                f'Нельзя заказать {item.quantity} шт. книги "{item.product.book.title}". Доступно: {item.product.book.quantity} шт.',
+                f'Нельзя заказать {item["quantity"]} шт. книги "{item["book"].title}". Доступно: {item["book"].quantity} шт.',
                 'error')
             return redirect(url_for('cart'))
-    # расчет общей стоимости с учетом скидок на товары
-    total = 0
-    items_with_prices = []
-    for item in cart_items:
-        product = Product.query.get(item.product_id)
-        if product and product.book:
-            final_price = get_book_price_with_discount(product.book)
-            item_total = final_price * item.quantity
-            total += item_total
-            items_with_prices.append({
-                'product': product,
-                'book': product.book,
-                'quantity': item.quantity,
-                'final_price': final_price,
-                'item_total': item_total,
-                'discount': float(product.discount or 0)
-            })
     final_total = total
     # делаем чтобы нельзя было заказать без указания адреса
     if request.method == 'POST':
@@ -503,7 +2672,7 @@ def checkout():
         if not delivery_address:
             flash('Заполните адрес доставки в профиле для оформления заказа', 'error')
             return redirect(url_for('profile'))
-        if payment_method == 'balance' and float(user.balance) < final_total:
+        if payment_method == 'balance' and user.balance < final_total:
             flash('Недостаточно средств на балансе', 'error')
             return redirect(url_for('checkout'))
         order = Order(
@@ -515,21 +2684,28 @@ def checkout():
         )
         db.session.add(order)
         db.session.flush()
-        for item in cart_items:
-            product = Product.query.get(item.product_id)
-            final_price = get_book_price_with_discount(product.book)
+        for item in items_with_prices:
             order_item = OrderItem(
                 order_id=order.id,
-                product_id=item.product_id,
-                quantity=item.quantity,
-                price_at_purchase=final_price  # сохраняем цену с учетом скидки
+                product_id=item['product'].id,
+                quantity=item['quantity'],
+                price_at_purchase=item['final_price']  # сохраняем цену с учетом скидки
             )
             db.session.add(order_item)
-            item.product.book.quantity -= item.quantity
+        # списание атомарное: если кто-то успел купить раньше, заказ откатывается целиком
+        missing = consume_stock(cart.id, items_with_prices)
+        if missing:
+            db.session.rollback()
+            flash(f'Книга "{missing["book"].title}" закончилась, пока вы оформляли заказ', 'error')
+            return redirect(url_for('cart'))
         # пока только баланс
-        if payment_method == 'balance':
-            user.balance -= final_total
+        if payment_method == 'balance' and not change_balance(user.id, -final_total, 'оплата заказа', order.id):
+            db.session.rollback()
+            flash('Недостаточно средств на балансе', 'error')
+            return redirect(url_for('checkout'))
         CartItem.query.filter_by(cart_id=cart.id).delete()
+        # статус, уведомления и сверку остатков делает воркер после коммита
+        enqueue_job('order_placed', order.id)
         db.session.commit()
         flash(f'Заказ успешно оформлен! Номер заказа: #{order.id}', 'success')
         return redirect(url_for('profile'))
@@ -538,10 +2714,21 @@ def checkout():
 
 @app.route('/profile', methods=['GET', 'POST'])
 def profile():
-    if 'user_id' not in session:
+    user = get_current_user()
+    if not user:
         return redirect(url_for('login'))
-    user = Users.query.get(session['user_id'])
-    orders = Order.query.filter_by(user_id=session['user_id']).all()
+    # история заказов постранично по ключу: новые первыми, следующая страница - заказы с id меньше orders_before
+    per_page = app.config['ORDER_HISTORY_PAGE_SIZE']
+    orders_before = request.args.get('orders_before', type=int)
+    query = Order.query.filter(Order.user_id == user.id)
+    if orders_before:
+        query = query.filter(Order.id < orders_before)
+    orders = query.order_by(Order.id.desc()).limit(per_page + 1).all()
+    orders_next = url_for('profile', orders_before=orders[per_page - 1].id) if len(orders) > per_page else None
+    orders = orders[:per_page]
+    # число книг во всех заказах страницы - одним запросом
+    item_counts = dict(db.session.query(OrderItem.order_id, func.sum(OrderItem.quantity)).filter(
+        OrderItem.order_id.in_([order.id for order in orders])).group_by(OrderItem.order_id).all()) if orders else {}
     payment_address = Address.query.filter_by(user_id=user.id, address_type='payment').first()
     delivery_address = Address.query.filter_by(user_id=user.id, address_type='delivery').first()
     if request.method == 'POST':
@@ -627,7 +2814,8 @@ def profile():
                 flash('Данные для входа сохранены', 'success')
             else:
                 flash('Неверный текущий пароль', 'error')
-    return render_template('profile.html', user=user, orders=orders,
+    return render_template('profile.html', user=user, orders=orders, item_counts=item_counts,
+                           orders_next=orders_next, orders_before=orders_before,
                            payment_address=payment_address, delivery_address=delivery_address)
 
 # создаем админа и типы пользователей
@@ -653,8 +2841,506 @@ def create_admin_user():
             db.session.add(admin)
             db.session.commit()
 
+# запросы маршрутов в том виде, в каком они идут в БД, - для проверки планов через EXPLAIN
+def route_queries():
+    user_id = db.session.query(func.max(Users.id)).scalar() or 0
+    book_id = (db.session.query(func.max(Book.id)).scalar() or 0) // 2
+    author_id = (db.session.query(func.max(Author.id)).scalar() or 0) // 2
+    genre = db.session.query(Book.genre).filter(Book.id >= book_id).limit(1).scalar()
+    queries = {
+        'адреса пользователя': Address.query.filter(Address.user_id == user_id, Address.address_type == 'payment'),
+        'корзина пользователя': Cart.query.filter_by(user_id=user_id),
+        'позиции корзины': CartItem.query.filter_by(cart_id=user_id),
+        'заказы пользователя': Order.query.filter_by(user_id=user_id),
+        'страница каталога': Book.query.filter(Book.id > book_id).order_by(Book.id).limit(24),
+        'авторы книги': db.session.query(book_author).filter(book_author.c.book_id == book_id),
+        'книги автора': db.session.query(book_author).filter(book_author.c.author_id == author_id),
+        'книги жанра': Book.query.filter_by(genre=genre),
+        'книги издательства': Book.query.filter_by(publisher='АСТ'),
+        'книги по цене': Book.query.filter(Book.final_price >= 300, Book.final_price < 500),
+        'автор по имени': Author.query.filter_by(last_name='Толстой', first_name='Лев'),
+        'истекшие брони': StockReservation.query.filter(StockReservation.expires_at < datetime.utcnow()),
+        'история заказов': Order.query.filter(Order.user_id == user_id, Order.id < 1000000).order_by(Order.id.desc()).limit(20),
+        'итоги продаж': SalesDaily.query.filter(SalesDaily.dimension == 'total', SalesDaily.day >= date.today() - timedelta(days=30)),
+        'задачи заказов': OrderJob.query.filter(OrderJob.status == 'pending', OrderJob.run_at <= datetime.utcnow()),
+    }
+    # поиск проверяем только на MySQL: в sqlite это LIKE по подстроке, который всегда просматривает таблицу
+    if db.engine.dialect.name == 'mysql':
+        queries['поиск книг'] = search_books_query(search_terms('преступление толстой'))
+    return queries
+
+# план запроса: список (таблица, полный просмотр?, оценка строк)
+def explain_query(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    connection = db.session.connection()
+    if db.engine.dialect.name == 'mysql':
+        rows = connection.exec_driver_sql(f'EXPLAIN {compiled}', params).mappings().all()
+        return [(row['table'], row['type'] == 'ALL', row['rows'] or 0) for row in rows]
+    # sqlite: SCAN без индекса - полный просмотр, оценки строк нет
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).all()
+    return [(row[3], row[3].startswith('SCAN') and 'INDEX' not in row[3], None) for row in rows]
 
-if __name__ == '__main__':
+@app.cli.command('explain-check')
+@click.option('--min-rows', default=1000, help='Полный просмотр меньших таблиц не считается ошибкой (MySQL).')
+def explain_check_command(min_rows):
+    """Проверить, что запросы маршрутов не делают полный просмотр таблиц (запускать на большой базе)."""
+    failed = False
+    for name, query in route_queries().items():
+        for table, full_scan, rows in explain_query(query):
+            if full_scan and (rows is None or rows >= min_rows):
+                failed = True
+                print(f"ПОЛНЫЙ ПРОСМОТР: {name}: {table} (строк: {rows if rows is not None else '?'})")
+    if failed:
+        sys.exit(1)
+    print("Полных просмотров нет")
+
+# импорт и экспорт каталога: CSV (авторы через ';', имя в порядке "Имя Отчество Фамилия") или JSONL.
+# книги сопоставляются по ISBN, пустые поля не меняют существующие значения
+CATALOG_FIELDS = ['isbn', 'title', 'authors', 'price', 'discount', 'quantity', 'genre', 'publisher',
+                  'publish_date', 'pages', 'description']
+CATALOG_BOOK_FIELDS = {
+    'title': str.strip, 'genre': str.strip, 'publisher': str.strip, 'description': str.strip,
+    'quantity': int, 'pages': int, 'publish_date': date.fromisoformat
+}
+# справочник авторов импорта растет с числом авторов, а не строк; при переполнении начинаем заново
+AUTHOR_CACHE_SIZE = 100000
+
+def split_author_name(name):
+    parts = name.split()
+    if len(parts) == 1:
+        return parts[0], None, None
+    return parts[0], parts[-1], ' '.join(parts[1:-1]) or None
+
+def format_author_name(first_name, last_name, middle_name):
+    return ' '.join(part for part in (first_name, middle_name, last_name) if part)
+
+def read_catalog(path, fmt):
+    with click.open_file(path, encoding='utf-8') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                row['authors'] = (row.get('authors') or '').split(';')
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+# строка файла -> (product, book, авторы или None, если поле не задано); ошибки - ValueError
+def parse_catalog_row(row):
+    isbn = str(row.get('isbn') or '').strip()
+    title = str(row.get('title') or '').strip()
+    if not isbn or not title:
+        raise ValueError('нет isbn или title')
+    try:
+        product = {'price': Decimal(str(row['price'])).quantize(CENTS)}
+        if row.get('discount') not in (None, ''):
+            product['discount'] = Decimal(str(row['discount'])).quantize(CENTS)
+    except (KeyError, InvalidOperation):
+        raise ValueError('неверная цена или скидка')
+    if product['price'] < 0 or not 0 <= product.get('discount', 0) <= 100:
+        raise ValueError('цена или скидка вне диапазона')
+    book = {'isbn': isbn}
+    for field, convert in CATALOG_BOOK_FIELDS.items():
+        if row.get(field) not in (None, ''):
+            book[field] = convert(row[field]) if isinstance(row[field], str) else row[field]
+    names = [split_author_name(name) for name in row.get('authors') or [] if name.strip()]
+    return product, book, names or None
+
+# INSERT ... ON DUPLICATE KEY UPDATE одним многострочным запросом (в sqlite - ON CONFLICT по keys).
+# increment=True - columns прибавляются к уже существующей строке, а не заменяют ее значения
+def upsert(table, rows, keys, columns, increment=False):
+    def value(column, new):
+        return table.c[column] + new[column] if increment else new[column]
+    if db.engine.dialect.name == 'mysql':
+        statement = mysql_insert(table).values(rows)
+        statement = statement.on_duplicate_key_update({column: value(column, statement.inserted) for column in columns})
+    else:
+        statement = sqlite_insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys, set_={column: value(column, statement.excluded) for column in columns})
+    db.session.execute(statement)
+
+# id авторов по именам: один запрос на пачку, недостающих создаем одним INSERT
+def resolve_authors(names, known):
+    if len(known) > AUTHOR_CACHE_SIZE:
+        known.clear()
+    def lookup(missing):
+        rows = db.session.execute(select(Author.id, Author.first_name, Author.last_name, Author.middle_name).where(or_(
+            Author.last_name.in_({name[1] for name in missing if name[1]}),
+            Author.last_name.is_(None) & Author.first_name.in_({name[0] for name in missing if not name[1]})
+        )))
+        for row in rows:
+            name = (row.first_name, row.last_name, row.middle_name or None)
+            if name in missing:
+                known.setdefault(name, row.id)
+    missing = {name for name in names if name not in known}
+    if missing:
+        lookup(missing)
+        new = [name for name in missing if name not in known]
+        if new:
+            db.session.execute(Author.__table__.insert(), [
+                {'first_name': first_name, 'last_name': last_name, 'middle_name': middle_name}
+                for first_name, last_name, middle_name in new
+            ])
+            lookup(set(new))
+
+# одна пачка в одной транзакции; возвращает число новых книг
+def import_catalog_batch(batch, known_authors):
+    isbns = list(batch)
+    existing = dict(db.session.execute(select(Book.isbn, Book.id).where(Book.isbn.in_(isbns))).all())
+    # id книги совпадает с id товара, новые раздаем подряд после максимального. новые товары пишем обычным INSERT:
+    # если этот id успел занять кто-то другой (админка, второй импорт), будет IntegrityError, а не перезапись
+    next_id = (db.session.query(func.max(Product.id)).scalar() or 0) + 1
+    ids = {}
+    for isbn in isbns:
+        if isbn in existing:
+            ids[isbn] = existing[isbn]
+        else:
+            ids[isbn] = next_id
+            next_id += 1
+
+    # в многострочном INSERT у всех строк одинаковые столбцы, поэтому группируем по набору полей
+    groups, new_products = {}, {}
+    for isbn, (product, book, names) in batch.items():
+        if isbn in existing:
+            groups.setdefault((Product.__table__, 'id', tuple(product)), []).append(
+                dict(product, id=ids[isbn], product_type='book'))
+        else:
+            new_products.setdefault(tuple(product), []).append(dict(product, id=ids[isbn], product_type='book'))
+        groups.setdefault((Book.__table__, 'isbn', tuple(book)), []).append(dict(book, id=ids[isbn]))
+    for rows in new_products.values():
+        db.session.execute(Product.__table__.insert(), rows)
+    for (table, key, columns), rows in sorted(groups.items(), key=lambda group: group[0][0] is Book.__table__):
+        upsert(table, rows, [key], [column for column in columns if column != key])
+
+    sync_final_prices(list(ids.values()))
+
+    linked = {ids[isbn]: names for isbn, (product, book, names) in batch.items() if names is not None}
+    resolve_authors({name for names in linked.values() for name in names}, known_authors)
+    changed_authors = {row.author_id for row in db.session.execute(
+        select(book_author.c.author_id).where(book_author.c.book_id.in_(list(ids.values()))).distinct())}
+    if linked:
+        db.session.execute(book_author.delete().where(book_author.c.book_id.in_(list(linked))))
+        links = {(known_authors[name], book_id) for book_id, names in linked.items() for name in names}
+        db.session.execute(book_author.insert(), [{'author_id': author_id, 'book_id': book_id} for author_id, book_id in links])
+        changed_authors.update(author_id for author_id, book_id in links)
+    # массовые INSERT идут мимо событий сессии - версии кэша отмечаем сами
+    mark_cache_changed('catalog', *(f'book:{book_id}' for book_id in ids.values()),
+                       *(f'author:{author_id}' for author_id in changed_authors))
+    mark_facets_changed(*ids.values())
+    db.session.commit()
+    return len(isbns) - len(existing)
+
+def import_catalog(rows, batch_size):
+    stats = {'rows': 0, 'created': 0, 'skipped': 0}
+    known_authors = {}
+    batch = {}
+    for line, row in enumerate(rows, 1):
+        stats['rows'] += 1
+        try:
+            product, book, names = parse_catalog_row(row)
+        except (ValueError, TypeError) as e:
+            stats['skipped'] += 1
+            click.echo(f"Строка {line} пропущена: {str(e)}", err=True)
+            continue
+        # повтор ISBN в одной пачке - непустые поля более поздней строки дополняют предыдущую
+        if book['isbn'] in batch:
+            click.echo(f"Строка {line}: ISBN {book['isbn']} повторяется, поля объединены", err=True)
+            earlier_product, earlier_book, earlier_names = batch[book['isbn']]
+            product, book = {**earlier_product, **product}, {**earlier_book, **book}
+            names = earlier_names if names is None else names
+        batch[book['isbn']] = (product, book, names)
+        if len(batch) >= batch_size:
+            stats['created'] += import_catalog_batch_retrying(batch, known_authors)
+            batch = {}
+            click.echo(f"Обработано строк: {stats['rows']}", err=True)
+    if batch:
+        stats['created'] += import_catalog_batch_retrying(batch, known_authors)
+    return stats
+
+# id новых книг занял параллельный INSERT - повторяем пачку с новыми id.
+# авторы, созданные в откаченной транзакции, из кэша убираем вместе с остальными
+def import_catalog_batch_retrying(batch, known_authors, attempts=3):
+    for attempt in range(1, attempts + 1):
+        try:
+            return import_catalog_batch(batch, known_authors)
+        except IntegrityError:
+            db.session.rollback()
+            known_authors.clear()
+            if attempt == attempts:
+                raise
+
+# книги с ценами и авторами пачками по id - память не зависит от размера каталога
+def export_catalog(batch_size):
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Book.id, Book.isbn, Book.title, Book.genre, Book.publisher, Book.publish_date, Book.description,
+                   Book.quantity, Book.pages, Product.price, Product.discount)
+            .join(Product, Product.id == Book.id).where(Book.id > last_id).order_by(Book.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        authors = {}
+        links = db.session.execute(
+            select(book_author.c.book_id, Author.first_name, Author.last_name, Author.middle_name)
+            .join(Author, Author.id == book_author.c.author_id)
+            .where(book_author.c.book_id.in_([row.id for row in rows])).order_by(Author.id)
+        )
+        for link in links:
+            authors.setdefault(link.book_id, []).append(format_author_name(link.first_name, link.last_name, link.middle_name))
+        for row in rows:
+            record = {field: getattr(row, field) for field in CATALOG_FIELDS if field != 'authors'}
+            record['authors'] = authors.get(row.id, [])
+            record['price'] = str(row.price)
+            record['discount'] = str(row.discount if row.discount is not None else 0)
+            record['publish_date'] = row.publish_date.isoformat() if row.publish_date else None
+            yield record
+        last_id = rows[-1].id
+
+def catalog_format(path, fmt):
+    return fmt or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+
+# массовые изменения: операция -> подпись. значение - скидка в %, сдвиг цены в % или изменение остатка в штуках
+BULK_OPERATIONS = {
+    'discount': 'Установить скидку, %',
+    'price': 'Изменить цену на, %',
+    'quantity': 'Изменить остаток на, шт.',
+}
+
+# текст ошибки или None, если значение подходит операции
+def check_bulk_value(operation, value):
+    if operation not in BULK_OPERATIONS:
+        return 'Неизвестная операция'
+    if value is None or not value.is_finite():
+        return 'Укажите число'
+    if operation == 'discount' and not 0 <= value <= 100:
+        return 'Скидка должна быть от 0 до 100'
+    if operation == 'price' and value <= -100:
+        return 'Цену нельзя снизить на 100% и больше'
+    if operation == 'quantity' and value != value.to_integral_value():
+        return 'Остаток меняется на целое число'
+    return None
+
+# условия отбора книг; пустые фильтры не участвуют. автор - по фамилии
+def bulk_conditions(genre=None, publisher=None, author=None, isbns=None):
+    conditions = []
+    if genre:
+        conditions.append(Book.genre == genre)
+    if publisher:
+        conditions.append(Book.publisher == publisher)
+    if author:
+        conditions.append(Book.id.in_(select(book_author.c.book_id).join(
+            Author, Author.id == book_author.c.author_id).where(Author.last_name == author)))
+    if isbns:
+        conditions.append(Book.isbn.in_(isbns))
+    return conditions
+
+def count_bulk_targets(conditions):
+    return db.session.execute(select(func.count(Book.id)).where(*conditions)).scalar()
+
+# один UPDATE ... WHERE id IN (...) на пачку; остаток не опускается ниже брони
+def apply_bulk_chunk(operation, value, book_ids):
+    if operation == 'discount':
+        Product.query.filter(Product.id.in_(book_ids)).update({Product.discount: value}, synchronize_session=False)
+    elif operation == 'price':
+        Product.query.filter(Product.id.in_(book_ids)).update(
+            {Product.price: func.round(Product.price * (100 + value) / 100.0, 2)}, synchronize_session=False)
+    else:
+        quantity = Book.quantity + int(value)
+        Book.query.filter(Book.id.in_(book_ids)).update(
+            {Book.quantity: case((quantity < Book.reserved_quantity, Book.reserved_quantity), else_=quantity)},
+            synchronize_session=False)
+    if operation != 'quantity':
+        sync_final_prices(book_ids)
+        mark_facets_changed(*book_ids)
+    else:
+        mark_stock_changed(*book_ids)
+    authors = db.session.execute(
+        select(book_author.c.author_id).where(book_author.c.book_id.in_(book_ids)).distinct()).scalars()
+    # UPDATE идут мимо событий сессии - версии кэша отмечаем сами
+    mark_cache_changed('catalog', *(f'book:{book_id}' for book_id in book_ids), *(f'author:{author_id}' for author_id in authors))
+
+# меняет книги под условия пачками по id с коммитом после каждой: блокировки строк держатся недолго,
+# а страницы и фасеты обновляются по мере прохода. возвращает число измененных книг
+def bulk_update(operation, value, conditions, chunk_size=1000):
+    last_id = 0
+    total = 0
+    while True:
+        book_ids = db.session.execute(
+            select(Book.id).where(Book.id > last_id, *conditions).order_by(Book.id).limit(chunk_size)
+        ).scalars().all()
+        if not book_ids:
+            return total
+        apply_bulk_chunk(operation, value, book_ids)
+        db.session.commit()
+        total += len(book_ids)
+        last_id = book_ids[-1]
+
+catalog_cli = AppGroup('catalog', help='Импорт и экспорт каталога.')
+
+@catalog_cli.command('import')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='По умолчанию - по расширению файла.')
+@click.option('--batch', default=1000, help='Книг в одной транзакции.')
+def catalog_import_command(path, fmt, batch):
+    """Загрузить книги из CSV/JSONL (PATH или - для stdin): новые ISBN добавляются, существующие обновляются."""
+    stats = import_catalog(read_catalog(path, catalog_format(path, fmt)), batch)
+    print(f"Строк: {stats['rows']}, новых книг: {stats['created']}, пропущено: {stats['skipped']}")
+
+@catalog_cli.command('export')
+@click.argument('path', default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='По умолчанию - по расширению файла.')
+@click.option('--batch', default=1000, help='Книг в одном запросе.')
+def catalog_export_command(path, fmt, batch):
+    """Выгрузить каталог в CSV/JSONL (PATH или - для stdout) в формате импорта."""
+    fmt = catalog_format(path, fmt)
+    count = 0
+    with click.open_file(path, 'w', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, CATALOG_FIELDS) if fmt == 'csv' else None
+        if writer:
+            writer.writeheader()
+        for record in export_catalog(batch):
+            if writer:
+                writer.writerow(dict(record, authors=';'.join(record['authors'])))
+            else:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+            if count % 10000 == 0:
+                click.echo(f"Выгружено книг: {count}", err=True)
+    click.echo(f"Выгружено книг: {count}", err=True)
+
+@catalog_cli.command('repair')
+def catalog_repair_command():
+    """Пересчитать итоговые цены книг, разошедшиеся с ценой и скидкой товара."""
+    fixed = sync_final_prices()
+    if fixed:
+        mark_cache_changed('catalog', 'facets')
+    db.session.commit()
+    print(f"Исправлено цен: {fixed}")
+
+# ignore_unknown_options - чтобы отрицательное значение (-10) не разбиралось как опция
+@catalog_cli.command('bulk', context_settings={'ignore_unknown_options': True})
+@click.argument('operation', type=click.Choice(list(BULK_OPERATIONS)))
+@click.argument('value')
+@click.option('--genre', help='Только книги жанра.')
+@click.option('--publisher', help='Только книги издательства.')
+@click.option('--author', help='Только книги авторов с этой фамилией.')
+@click.option('--isbn', 'isbns', multiple=True, help='Только книги с этими ISBN (можно повторять).')
+@click.option('--all', 'everything', is_flag=True, help='Весь каталог, если фильтров нет.')
+@click.option('--chunk', default=1000, help='Книг в одном UPDATE.')
+@click.option('--dry-run', is_flag=True, help='Только показать, сколько книг изменится.')
+def catalog_bulk_command(operation, value, genre, publisher, author, isbns, everything, chunk, dry_run):
+    """Массово изменить книги: discount 15 - скидка 15%, price -10 - цена на 10% ниже, quantity 5 - остаток +5."""
+    value = parse_decimal(value)
+    error = check_bulk_value(operation, value)
+    if error:
+        print(error)
+        sys.exit(1)
+    conditions = bulk_conditions(genre, publisher, author, isbns)
+    if not conditions and not everything:
+        print("Укажите фильтр или --all")
+        sys.exit(1)
+    if dry_run:
+        print(f"Будет изменено книг: {count_bulk_targets(conditions)}")
+        return
+    print(f"Изменено книг: {bulk_update(operation, value, conditions, chunk)}")
+
+app.cli.add_command(catalog_cli)
+
+covers_cli = AppGroup('covers', help='Обложки книг.')
+
+@covers_cli.command('build')
+@click.option('--workers', type=int, help='Процессов (по умолчанию COVER_WORKERS).')
+@click.option('--prune', is_flag=True, help='Удалить миниатюры старых версий обложек.')
+def covers_build_command(workers, prune):
+    """Создать недостающие миниатюры обложек (после ручной замены файлов или смены размеров)."""
+    os.makedirs(THUMBS_DIR, exist_ok=True)
+    files = load_cover_manifest()
+    current, failed, created = set(), set(), 0
+    with ProcessPoolExecutor(max_workers=workers or app.config['COVER_WORKERS']) as pool:
+        futures = {pool.submit(build_thumbnails, filename): book_id for book_id, filename in files.items()}
+        for future in as_completed(futures):
+            try:
+                names, count = future.result()
+            except (OSError, ValueError) as e:
+                failed.add(futures[future])
+                print(f"Не удалось обработать обложку книги #{futures[future]}: {str(e)}")
+                continue
+            current.update(names)
+            created += count
+    removed = 0
+    if prune:
+        for entry in scan_dir(THUMBS_DIR):
+            found = THUMB_NAME.match(entry.name)
+            if found and entry.name not in current and int(found.group(1)) not in failed:
+                os.remove(entry.path)
+                removed += 1
+    print(f"Обложек: {len(files)}, создано миниатюр: {created}, удалено старых: {removed}, ошибок: {len(failed)}")
+
+app.cli.add_command(covers_cli)
+
+recommendations_cli = AppGroup('recommendations', help='Рекомендации "с этой книгой покупают".')
+
+@recommendations_cli.command('build')
+@click.option('--full', is_flag=True, help='Пересчитать по всем заказам (иначе - только новые заказы).')
+@click.option('--batch', default=1000, help='Заказов за один запрос.')
+def recommendations_build_command(full, batch):
+    """Пересчитать соседей книг по совместным покупкам, авторам и жанрам."""
+    counted, written = build_recommendations(full, batch)
+    if written:
+        print(f"Учтено заказов: {counted}, книг в рекомендациях: {written}")
+    else:
+        print("Новых заказов нет")
+
+app.cli.add_command(recommendations_cli)
+
+# ждем пока бд запустится: повторяем подключение с растущей паузой вместо фиксированного sleep
+def wait_for_db():
+    delay = app.config['DB_CONNECT_BACKOFF']
+    for attempt in range(1, app.config['DB_CONNECT_RETRIES'] + 1):
+        try:
+            with app.app_context():
+                with db.engine.connect() as connection:
+                    connection.execute(text('SELECT 1'))
+            return
+        except OperationalError as e:
+            if attempt == app.config['DB_CONNECT_RETRIES']:
+                raise
+            print(f"БД недоступна (попытка {attempt}): {str(e)}")
+            time.sleep(delay)
+            delay = min(delay * 2, app.config['DB_CONNECT_BACKOFF_MAX'])
+
+# точка входа для gunicorn/uwsgi: gunicorn -w 4 'app:create_app()'
+# начальные данные сюда не входят - их создает flask bootstrap один раз при деплое
+def create_app():
+    wait_for_db()
+    return app
+
+# применяет миграции; база без alembic_version создана исходным init.sql - считаем ее первой ревизией
+def upgrade_database():
     with app.app_context():
-        create_admin_user()  
-    app.run(debug=True, host='0.0.0.0', port=5000)
+        if not inspect(db.engine).has_table('alembic_version'):
+            stamp_schema(revision='0001')
+        upgrade_schema()
+
+@app.cli.command('bootstrap')
+def bootstrap_command():
+    """Дождаться БД, применить миграции и создать типы пользователей и админа (повторный запуск ничего не меняет)."""
+    wait_for_db()
+    upgrade_database()
+    try:
+        create_admin_user()
+    except IntegrityError:
+        # параллельный деплой успел создать те же записи
+        db.session.rollback()
+    print("Начальные данные на месте")
+
+
+if __name__ == '__main__':
+    wait_for_db()
+    create_admin_user()
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000)
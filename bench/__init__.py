@@ -0,0 +1 @@
+# нагрузочное тестирование: генератор большого каталога (bench.seed) и нагрузка (bench.load)
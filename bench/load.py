@@ -0,0 +1,235 @@
+# нагрузка смесью сценариев и отчет по задержкам:
+#   python -m bench.load --duration 60 --users 20 --mix browse=50,search=25,cart=15,checkout=10
+# по умолчанию запросы идут в приложение в этом же процессе через test_client - так видно число SQL-запросов.
+# с --url нагружается запущенный сервер по HTTP (число запросов к БД тогда не известно).
+# --save NAME сохраняет результат в bench/baselines/NAME.json, --compare NAME сравнивает с ним
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event, func
+
+from app import app, db, Book, Users
+from bench.seed import BENCH_PASSWORD, WORDS
+
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+# счетчик SQL-запросов текущего потока (только для запуска в процессе)
+query_counter = threading.local()
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    query_counter.value = getattr(query_counter, 'value', 0) + 1
+
+
+# клиент в процессе: test_client со своими cookie у каждого виртуального пользователя
+class LocalClient:
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        query_counter.value = 0
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, len(response.data), query_counter.value
+
+
+# HTTP-клиент к запущенному серверу, редиректы не раскрываем - меряем сам запрос
+class HttpClient:
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                return response.status, len(response.read()), None
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read()), None
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, name, seconds, status, queries):
+        with self.lock:
+            self.samples.setdefault(name, []).append((seconds, status, queries))
+
+
+def timed(client, recorder, name, method, path, data=None):
+    started = time.perf_counter()
+    status, size, queries = client.request(method, path, data)
+    recorder.add(name, time.perf_counter() - started, status, queries)
+    return status
+
+
+# сценарии: каждый - одна "сессия" пользователя из нескольких запросов
+def scenario_browse(client, recorder, ctx, rng):
+    timed(client, recorder, 'home', 'GET', '/')
+    after = rng.randrange(ctx['min_book'], ctx['max_book'])
+    timed(client, recorder, 'catalog', 'GET', f'/catalog?after={after}')
+    timed(client, recorder, 'book', 'GET', f'/book/{rng.randrange(ctx["min_book"], ctx["max_book"] + 1)}')
+
+
+def scenario_search(client, recorder, ctx, rng):
+    timed(client, recorder, 'search', 'GET', '/catalog?' + urllib.parse.urlencode({'q': rng.choice(WORDS)}))
+
+
+def login(client, recorder, ctx, rng):
+    if not getattr(client, 'logged_in', False):
+        username = f'bench_{rng.randrange(ctx["min_user"], ctx["max_user"] + 1)}'
+        timed(client, recorder, 'login', 'POST', '/login', {'username': username, 'password': BENCH_PASSWORD})
+        client.logged_in = True
+
+
+def scenario_cart(client, recorder, ctx, rng):
+    login(client, recorder, ctx, rng)
+    timed(client, recorder, 'add_to_cart', 'GET', f'/add_to_cart/{rng.randrange(ctx["min_book"], ctx["max_book"] + 1)}')
+    timed(client, recorder, 'cart', 'GET', '/cart')
+
+
+def scenario_checkout(client, recorder, ctx, rng):
+    scenario_cart(client, recorder, ctx, rng)
+    timed(client, recorder, 'checkout_page', 'GET', '/checkout')
+    timed(client, recorder, 'checkout', 'POST', '/checkout', {'payment_method': 'balance'})
+
+
+SCENARIOS = {
+    'browse': scenario_browse,
+    'search': scenario_search,
+    'cart': scenario_cart,
+    'checkout': scenario_checkout,
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(recorder, elapsed):
+    report = {}
+    total = 0
+    for name, samples in sorted(recorder.samples.items()):
+        latencies = [seconds * 1000 for seconds, _, _ in samples]
+        queries = [q for _, _, q in samples if q is not None]
+        total += len(samples)
+        report[name] = {
+            'requests': len(samples),
+            'errors': sum(1 for _, status, _ in samples if status >= 500),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        }
+    return {'endpoints': report, 'total_requests': total, 'throughput_rps': round(total / elapsed, 2)}
+
+
+def print_report(result):
+    print(f"{'запрос':<15}{'кол-во':>8}{'ошибок':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'SQL/запр':>10}")
+    for name, row in result['endpoints'].items():
+        queries = row['queries_per_request'] if row['queries_per_request'] is not None else '-'
+        print(f"{name:<15}{row['requests']:>8}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['p99_ms']:>10}{queries:>10}")
+    print(f"всего запросов: {result['total_requests']}, пропускная способность: {result['throughput_rps']} запр/с")
+
+
+# сравнение с сохраненным результатом: рост p95 или числа SQL-запросов больше порога - регрессия
+def compare(result, baseline, threshold):
+    regressions = []
+    for name, row in result['endpoints'].items():
+        base = baseline['endpoints'].get(name)
+        if not base:
+            continue
+        for metric in ('p95_ms', 'queries_per_request'):
+            if row[metric] is None or not base[metric]:
+                continue
+            change = (row[metric] - base[metric]) / base[metric]
+            marker = '  РЕГРЕССИЯ' if change > threshold else ''
+            print(f"{name:<15}{metric:<22}{base[metric]:>10} -> {row[metric]:<10}{change:+.0%}{marker}")
+            if marker:
+                regressions.append((name, metric))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузка на магазин смесью сценариев.')
+    parser.add_argument('--url', help='адрес запущенного сервера; без него - в процессе через test_client')
+    parser.add_argument('--users', type=int, default=10, help='виртуальных пользователей (потоков)')
+    parser.add_argument('--duration', type=float, default=30, help='секунд нагрузки')
+    parser.add_argument('--mix', default='browse=50,search=25,cart=15,checkout=10')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='NAME', help='сохранить результат как базовый')
+    parser.add_argument('--compare', metavar='NAME', help='сравнить с сохраненным результатом')
+    parser.add_argument('--threshold', type=float, default=0.2, help='допустимый рост метрики (доля)')
+    args = parser.parse_args()
+
+    mix = dict(item.split('=') for item in args.mix.split(','))
+    names = list(mix)
+    weights = [float(mix[name]) for name in names]
+
+    with app.app_context():
+        ctx = {
+            'min_book': db.session.query(func.min(Book.id)).scalar(),
+            'max_book': db.session.query(func.max(Book.id)).scalar(),
+            'min_user': db.session.query(func.min(Users.id)).filter(Users.username.like('bench_%')).scalar(),
+            'max_user': db.session.query(func.max(Users.id)).filter(Users.username.like('bench_%')).scalar(),
+        }
+        if ctx['min_book'] is None or ctx['min_user'] is None:
+            raise SystemExit('База пуста - сначала python -m bench.seed')
+        if not args.url:
+            event.listen(db.engine, 'before_cursor_execute', count_query)
+
+    recorder = Recorder()
+    deadline = time.monotonic() + args.duration
+
+    def virtual_user(number):
+        rng = random.Random(args.seed + number)
+        client = HttpClient(args.url) if args.url else LocalClient()
+        while time.monotonic() < deadline:
+            SCENARIOS[rng.choices(names, weights)[0]](client, recorder, ctx, rng)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(virtual_user, range(args.users)))
+    result = summarize(recorder, time.monotonic() - started)
+    result.update(commit=git_commit(), mode='http' if args.url else 'local', users=args.users, mix=args.mix)
+    print_report(result)
+
+    if args.save:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(os.path.join(BASELINES_DIR, f'{args.save}.json'), 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(os.path.join(BASELINES_DIR, f'{args.compare}.json'), encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"сравнение с {args.compare} (коммит {baseline.get('commit')}):")
+        if compare(result, baseline, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
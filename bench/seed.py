@@ -0,0 +1,124 @@
+# заполняет базу синтетическим каталогом для замеров:
+#   python -m bench.seed --books 100000 --authors 20000 --users 50000
+# БД берется из DATABASE_URL, как и у приложения (MySQL или sqlite для локальных прогонов)
+import argparse
+import random
+from datetime import date, datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from app import app, db, Product, Book, Author, book_author, Users, Cart, CartItem, Address, price_with_discount
+
+BENCH_PASSWORD = 'bench'
+WORDS = [
+    'война', 'мир', 'преступление', 'наказание', 'тайна', 'дом', 'море', 'звезда', 'город', 'сад',
+    'ночь', 'день', 'путь', 'сердце', 'огонь', 'зима', 'лето', 'король', 'принц', 'волшебник',
+    'камень', 'река', 'лес', 'история', 'жизнь', 'судьба', 'дорога', 'тень', 'свет', 'память'
+]
+GENRES = ['Классика', 'Фэнтези', 'Детектив', 'Фантастика', 'Роман', 'Поэзия', 'История', 'Сатира']
+PUBLISHERS = ['АСТ', 'Эксмо', 'Махаон', 'Азбука', 'Питер', 'МИФ']
+FIRST_NAMES = ['Иван', 'Анна', 'Петр', 'Мария', 'Лев', 'Ольга', 'Федор', 'Елена', 'Антон', 'Нина']
+LAST_NAMES = ['Иванов', 'Петрова', 'Сидоров', 'Кузнецова', 'Смирнов', 'Попова', 'Волков', 'Соколова']
+
+
+# вставка пачками: один многострочный INSERT на chunk строк
+def insert_chunked(table, rows, chunk):
+    for start in range(0, len(rows), chunk):
+        db.session.execute(table.insert(), rows[start:start + chunk])
+        db.session.commit()
+
+
+def next_id(column):
+    return (db.session.query(db.func.max(column)).scalar() or 0) + 1
+
+
+def seed(books, authors, users, cart_items, chunk, rng):
+    first_author = next_id(Author.id)
+    author_rows = [{
+        'id': first_author + i,
+        'first_name': rng.choice(FIRST_NAMES),
+        'last_name': f'{rng.choice(LAST_NAMES)}-{i}',
+        'birth_date': date(1800, 1, 1) + timedelta(days=rng.randrange(70000)),
+        'country': 'Россия',
+        'biography': ' '.join(rng.choices(WORDS, k=20))
+    } for i in range(authors)]
+    insert_chunked(Author.__table__, author_rows, chunk)
+    print(f'авторов: {authors}')
+
+    first_book = next_id(Product.id)
+    product_rows, book_rows, link_rows = [], [], []
+    for i in range(books):
+        book_id = first_book + i
+        product_rows.append({
+            'id': book_id,
+            'price': rng.randrange(150, 3000),
+            'discount': rng.choice([0, 0, 0, 5, 10, 15, 25]),
+            'product_type': 'book'
+        })
+        final_price = price_with_discount(product_rows[-1]['price'], product_rows[-1]['discount'])
+        book_rows.append({
+            'id': book_id,
+            'isbn': f'978-0-{book_id:09d}',
+            'title': ' '.join(rng.choices(WORDS, k=3)).capitalize(),
+            'publisher': rng.choice(PUBLISHERS),
+            'publish_date': date(1850, 1, 1) + timedelta(days=rng.randrange(63000)),
+            'description': ' '.join(rng.choices(WORDS, k=30)),
+            'genre': rng.choice(GENRES),
+            'quantity': rng.randrange(0, 50),
+            'pages': rng.randrange(50, 1500),
+            'reserved_quantity': 0,
+            'final_price': final_price
+        })
+        for author_id in set(rng.choices(range(first_author, first_author + authors), k=rng.choice([1, 1, 1, 2]))):
+            link_rows.append({'author_id': author_id, 'book_id': book_id})
+    insert_chunked(Product.__table__, product_rows, chunk)
+    insert_chunked(Book.__table__, book_rows, chunk)
+    insert_chunked(book_author, link_rows, chunk)
+    print(f'книг: {books}')
+
+    # хэш пароля считаем один раз - он одинаковый у всех тестовых пользователей
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    first_user = next_id(Users.id)
+    first_cart = next_id(Cart.id)
+    user_rows, cart_rows, address_rows, item_rows = [], [], [], []
+    now = datetime.utcnow()
+    for i in range(users):
+        user_id = first_user + i
+        user_rows.append({
+            'id': user_id, 'user_type_id': 2, 'username': f'bench_{user_id}', 'email': f'bench_{user_id}@bench.local',
+            'password_hash': password_hash, 'first_name': rng.choice(FIRST_NAMES), 'last_name': rng.choice(LAST_NAMES),
+            'balance': 100000, 'balance_version': 0, 'registration_date': now
+        })
+        cart_rows.append({'id': first_cart + i, 'user_id': user_id})
+        for address_type in ('payment', 'delivery'):
+            address_rows.append({
+                'user_id': user_id, 'address_type': address_type, 'street': 'Ленина', 'city': 'Москва',
+                'house': str(rng.randrange(1, 200)), 'postal_code': '101000', 'country': 'Россия'
+            })
+        for book_id in set(rng.choices(range(first_book, first_book + books), k=rng.randrange(cart_items + 1))):
+            item_rows.append({'cart_id': first_cart + i, 'product_id': book_id, 'quantity': 1})
+    insert_chunked(Users.__table__, user_rows, chunk)
+    insert_chunked(Cart.__table__, cart_rows, chunk)
+    insert_chunked(Address.__table__, address_rows, chunk)
+    insert_chunked(CartItem.__table__, item_rows, chunk)
+    print(f'пользователей: {users}, позиций в корзинах: {len(item_rows)} (пароль: {BENCH_PASSWORD})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Синтетический каталог для замеров.')
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--authors', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--cart-items', type=int, default=5, help='максимум позиций в корзине пользователя')
+    parser.add_argument('--chunk', type=int, default=5000, help='строк в одном INSERT')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--create-tables', action='store_true', help='создать таблицы по моделям (для sqlite)')
+    args = parser.parse_args()
+    with app.app_context():
+        if args.create_tables:
+            db.create_all()
+        seed(args.books, args.authors, args.users, args.cart_items, args.chunk, random.Random(args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,5 +6,87 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'secret-key'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'mysql+mysqlconnector://bookuser:password@db/bookstore?charset=utf8mb4'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # пул соединений на процесс; pre_ping и recycle - чтобы не получать соединения, закрытые MySQL по wait_timeout
+    SQLALCHEMY_ENGINE_OPTIONS = {} if SQLALCHEMY_DATABASE_URI.startswith('sqlite') else {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 280)),
+    }
+    # ожидание БД при старте: число попыток и пауза (сек), удваивается до максимума
+    DB_CONNECT_RETRIES = int(os.environ.get('DB_CONNECT_RETRIES', 30))
+    DB_CONNECT_BACKOFF = 0.2
+    DB_CONNECT_BACKOFF_MAX = 5
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
-    ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
\ No newline at end of file
+    ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+    # каталог
+    CATALOG_PAGE_SIZE = 24
+    CATALOG_MAX_PAGE_SIZE = 100
+    # как часто (сек) проверять папку обложек на изменения
+    COVER_MANIFEST_CHECK_INTERVAL = 5
+    # кэш горячих полей пользователя на процесс (сек), 0 - выключен
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 0))
+    USER_CACHE_SIZE = 10000
+    # бронь товара в корзине (мин) и период снятия истекших броней (сек), 0 - без фонового потока
+    STOCK_HOLD_MINUTES = 30
+    STOCK_SWEEP_INTERVAL = int(os.environ.get('STOCK_SWEEP_INTERVAL', 60))
+    # очередь заказов: потоки воркера, пауза при пустой очереди (с), срок аренды задачи (с),
+    # попыток до failed и пауза перед повтором (удваивается с каждой попыткой)
+    ORDER_WORKER_THREADS = int(os.environ.get('ORDER_WORKER_THREADS', 4))
+    ORDER_WORKER_POLL = 1.0
+    ORDER_JOB_LEASE_SECONDS = 300
+    ORDER_JOB_MAX_ATTEMPTS = 5
+    ORDER_JOB_RETRY_SECONDS = 30
+    # сколько разных книг гость может положить в корзину (она хранится в его сессии)
+    GUEST_CART_MAX_ITEMS = 50
+    # заказов на странице истории в профиле и строк в топах отчета по продажам
+    ORDER_HISTORY_PAGE_SIZE = 20
+    SALES_REPORT_TOP = 20
+    # кэш страниц для гостей и карточек книг: memory (на процесс) или file (общий для воркеров)
+    PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+    PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR') or os.path.join(basedir, 'cache', 'pages')
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 300))
+    PAGE_CACHE_SIZE = 2000
+    # как долго (сек) ETag страницы гостя остается прежним, если ее версии не менялись:
+    # столько максимум отстают остатки на карточках в списках
+    PAGE_ETAG_SECONDS = int(os.environ.get('PAGE_ETAG_SECONDS', 300))
+    # сессии на сервере: file (общие для воркеров на одной машине) или memory (на процесс, для разработки);
+    # срок жизни (сек) продлевается при использовании
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'file')
+    SESSION_DIR = os.environ.get('SESSION_DIR') or os.path.join(basedir, 'cache', 'sessions')
+    SESSION_LIFETIME = int(os.environ.get('SESSION_LIFETIME', 7 * 24 * 3600))
+    SESSION_MEMORY_SIZE = 100000
+    # сжатие ответов: меньше COMPRESS_MIN_SIZE байт не сжимаем, уровни gzip (1-9) и brotli (0-11)
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 5
+    # книги дня на главной: uniform, discount (чаще со скидкой) или stock (чаще с большим остатком)
+    FEATURED_WEIGHTING = os.environ.get('FEATURED_WEIGHTING', 'uniform')
+    FEATURED_REFRESH_SECONDS = 300
+    # рекомендации "с этой книгой покупают": файл с соседями книг и статистикой (.state рядом), соседей на книгу,
+    # сколько показывать, как часто веб проверяет файл (сек) и воркер заказов дописывает новые заказы (сек, 0 - не дописывает),
+    # возраст заказа (сек), после которого он учитывается, и сколько позиций одного заказа берется в пары
+    RECOMMENDATIONS_PATH = os.environ.get('RECOMMENDATIONS_PATH') or os.path.join(basedir, 'cache', 'recommendations', 'books.bin')
+    RECOMMENDATIONS_K = 8
+    RECOMMENDATIONS_SHOWN = 4
+    RECOMMENDATIONS_CHECK_INTERVAL = 30
+    RECOMMENDATIONS_REFRESH_SECONDS = int(os.environ.get('RECOMMENDATIONS_REFRESH_SECONDS', 600))
+    RECOMMENDATIONS_ORDER_DELAY = 60
+    RECOMMENDATIONS_MAX_ORDER_ITEMS = 50
+    # фасеты каталога: границы ценовых диапазонов (руб.) и сколько значений жанра/издательства показывать
+    FACET_PRICE_BANDS = [300, 500, 1000, 2000]
+    FACET_MAX_VALUES = 15
+    # как часто (сек) пересобирать индекс фасетов в фоновом потоке, даже если версия 'facets' в этом процессе не менялась; 0 - не пересобирать
+    FACET_REFRESH_SECONDS = int(os.environ.get('FACET_REFRESH_SECONDS', 60))
+    # мониторинг: сколько повторов одного SQL за запрос считать N+1,
+    # доля профилируемых запросов и порог (мс), после которого профиль сохраняется в PROFILE_DIR
+    N_PLUS_ONE_THRESHOLD = 10
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_THRESHOLD_MS = int(os.environ.get('PROFILE_THRESHOLD_MS', 500))
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'cache', 'profiles')
+    # миниатюры обложек: размер -> рамка (ширина, высота) с запасом под экраны с высокой плотностью,
+    # качество WebP/JPEG, процессы для flask covers build и срок кэша в браузере
+    COVER_THUMB_SIZES = {'card': (300, 450), 'detail': (480, 720), 'admin': (100, 150)}
+    COVER_THUMB_QUALITY = 80
+    COVER_WORKERS = int(os.environ.get('COVER_WORKERS', os.cpu_count() or 1))
+    COVER_THUMB_MAX_AGE = 365 * 24 * 3600
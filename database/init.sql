@@ -26,6 +26,7 @@ CREATE TABLE IF NOT EXISTS users (
     phone VARCHAR(20),
     email VARCHAR(150) UNIQUE,
     balance DECIMAL(10,2) DEFAULT 0,
+    balance_version INT NOT NULL DEFAULT 0,
     registration_date DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (user_type_id) REFERENCES user_type(id)
 );
@@ -50,7 +51,16 @@ CREATE TABLE IF NOT EXISTS book (
     quantity INT DEFAULT 0,
     pages INT,
     reserved_quantity INT DEFAULT 0,
-    FOREIGN KEY (id) REFERENCES product(id)
+    final_price DECIMAL(10,2),
+    available_quantity INT GENERATED ALWAYS AS (quantity - reserved_quantity) STORED,
+    INDEX ix_book_title (title),
+    INDEX ix_book_genre (genre),
+    INDEX ix_book_publisher (publisher),
+    INDEX ix_book_publish_date (publish_date),
+    INDEX ix_book_final_price (final_price),
+    INDEX ix_book_available_quantity (available_quantity),
+    FOREIGN KEY (id) REFERENCES product(id),
+    FULLTEXT KEY ft_book_search (title, genre, description)
 );
 
 -- Author
@@ -61,7 +71,9 @@ CREATE TABLE IF NOT EXISTS author (
     middle_name VARCHAR(100),
     birth_date DATE,
     country VARCHAR(100),
-    biography TEXT
+    biography TEXT,
+    INDEX ix_author_name (last_name, first_name),
+    FULLTEXT KEY ft_author_name (first_name, last_name, middle_name)
 );
 
 -- Book-Author Relationship
@@ -69,6 +81,7 @@ CREATE TABLE IF NOT EXISTS book_author (
     author_id INT,
     book_id INT,
     PRIMARY KEY (author_id, book_id),
+    INDEX ix_book_author_book_id (book_id),
     FOREIGN KEY (author_id) REFERENCES author(id),
     FOREIGN KEY (book_id) REFERENCES book(id)
 );
@@ -83,6 +96,7 @@ CREATE TABLE IF NOT EXISTS address (
     postal_code VARCHAR(20),
     house VARCHAR(50),
     country VARCHAR(100),
+    INDEX ix_address_user_type (user_id, address_type),
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
@@ -90,6 +104,7 @@ CREATE TABLE IF NOT EXISTS address (
 CREATE TABLE IF NOT EXISTS cart (
     id INT AUTO_INCREMENT PRIMARY KEY,
     user_id INT,
+    INDEX ix_cart_user_id (user_id),
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
@@ -103,6 +118,18 @@ CREATE TABLE IF NOT EXISTS cart_item (
     FOREIGN KEY (product_id) REFERENCES product(id)
 );
 
+-- Stock Reservation (бронь товара под корзину)
+CREATE TABLE IF NOT EXISTS stock_reservation (
+    cart_id INT,
+    product_id INT,
+    quantity INT NOT NULL DEFAULT 0,
+    expires_at DATETIME NOT NULL,
+    PRIMARY KEY (cart_id, product_id),
+    INDEX ix_stock_reservation_expires_at (expires_at),
+    FOREIGN KEY (cart_id) REFERENCES cart(id),
+    FOREIGN KEY (product_id) REFERENCES product(id)
+);
+
 -- Order
 CREATE TABLE IF NOT EXISTS order_table (
     id INT AUTO_INCREMENT PRIMARY KEY,
@@ -112,6 +139,9 @@ CREATE TABLE IF NOT EXISTS order_table (
     payment_method VARCHAR(50),
     status VARCHAR(50) DEFAULT 'обрабатывается',
     total_amount DECIMAL(10,2) DEFAULT 0,
+    order_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+    counted_in_sales BOOLEAN NOT NULL DEFAULT FALSE,
+    INDEX ix_order_table_user_id (user_id),
     FOREIGN KEY (user_id) REFERENCES users(id),
     FOREIGN KEY (delivery_address_id) REFERENCES address(id),
     FOREIGN KEY (payment_address_id) REFERENCES address(id)
@@ -128,6 +158,61 @@ CREATE TABLE IF NOT EXISTS order_item (
     FOREIGN KEY (product_id) REFERENCES product(id)
 );
 
+-- Order Job (очередь задач по заказам, выполняет flask orders worker)
+CREATE TABLE IF NOT EXISTS order_job (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    order_id INT,
+    payload TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    run_at DATETIME NOT NULL,
+    last_error TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_order_job_status_run_at (status, run_at),
+    FOREIGN KEY (order_id) REFERENCES order_table(id)
+);
+
+-- Sales Daily (дневные итоги продаж для отчетов: total, book, genre, author)
+CREATE TABLE IF NOT EXISTS sales_daily (
+    dimension VARCHAR(10) NOT NULL,
+    day DATE NOT NULL,
+    dimension_key VARCHAR(255) NOT NULL DEFAULT '',
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(12,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, day, dimension_key)
+);
+
+-- Balance Ledger (журнал операций по балансу)
+CREATE TABLE IF NOT EXISTS balance_ledger (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    amount DECIMAL(10,2) NOT NULL,
+    reason VARCHAR(50) NOT NULL,
+    order_id INT,
+    balance_version INT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_balance_ledger_user_version (user_id, balance_version),
+    FOREIGN KEY (user_id) REFERENCES users(id),
+    FOREIGN KEY (order_id) REFERENCES order_table(id)
+);
+
+-- Balance Snapshot (снимки балансов)
+CREATE TABLE IF NOT EXISTS balance_snapshot (
+    user_id INT PRIMARY KEY,
+    balance DECIMAL(10,2) NOT NULL,
+    balance_version INT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+-- версия схемы для миграций (flask db upgrade): init.sql соответствует последней ревизии
+CREATE TABLE IF NOT EXISTS alembic_version (
+    version_num VARCHAR(32) NOT NULL PRIMARY KEY
+);
+INSERT IGNORE INTO alembic_version (version_num) VALUES ('0009');
+
 -- Типы пользователей
 INSERT IGNORE INTO user_type (id, type_name) VALUES
 (1, 'Администратор'),
@@ -173,3 +258,6 @@ INSERT IGNORE INTO book_author (author_id, book_id) VALUES
 (1, 6),
 (2, 7),
 (4, 8);
+
+-- итоговые цены тестовых книг (дальше их поддерживает приложение)
+UPDATE book SET final_price = (SELECT ROUND(price * (100 - COALESCE(discount, 0)) / 100, 2) FROM product WHERE product.id = book.id);
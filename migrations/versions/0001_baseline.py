@@ -0,0 +1,25 @@
+"""baseline: схема из исходного database/init.sql
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # таблицы уже созданы init.sql, эта ревизия только точка отсчета для существующих баз
+    pass
+
+
+def downgrade():
+    pass
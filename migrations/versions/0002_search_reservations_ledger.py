@@ -0,0 +1,59 @@
+"""полнотекстовый поиск, брони товара, журнал баланса
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ft_book_search', 'book', ['title', 'genre', 'description'], mysql_prefix='FULLTEXT')
+    op.create_index('ft_author_name', 'author', ['first_name', 'last_name', 'middle_name'], mysql_prefix='FULLTEXT')
+
+    op.create_table(
+        'stock_reservation',
+        sa.Column('cart_id', sa.Integer(), sa.ForeignKey('cart.id'), primary_key=True),
+        sa.Column('product_id', sa.Integer(), sa.ForeignKey('product.id'), primary_key=True),
+        sa.Column('quantity', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+    )
+    op.create_index('ix_stock_reservation_expires_at', 'stock_reservation', ['expires_at'])
+
+    op.add_column('users', sa.Column('balance_version', sa.Integer(), nullable=False, server_default='0'))
+    op.create_table(
+        'balance_ledger',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('amount', sa.Numeric(10, 2), nullable=False),
+        sa.Column('reason', sa.String(50), nullable=False),
+        sa.Column('order_id', sa.Integer(), sa.ForeignKey('order_table.id')),
+        sa.Column('balance_version', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.func.now()),
+    )
+    op.create_index('ix_balance_ledger_user_version', 'balance_ledger', ['user_id', 'balance_version'])
+    op.create_table(
+        'balance_snapshot',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), primary_key=True),
+        sa.Column('balance', sa.Numeric(10, 2), nullable=False),
+        sa.Column('balance_version', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.func.now()),
+    )
+
+
+def downgrade():
+    op.drop_table('balance_snapshot')
+    op.drop_table('balance_ledger')
+    op.drop_column('users', 'balance_version')
+    op.drop_table('stock_reservation')
+    op.drop_index('ft_author_name', table_name='author')
+    op.drop_index('ft_book_search', table_name='book')
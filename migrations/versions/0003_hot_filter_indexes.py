@@ -0,0 +1,38 @@
+"""индексы для фильтров маршрутов, дата заказа, тип баланса
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_address_user_type', 'address', ['user_id', 'address_type'])
+    op.create_index('ix_cart_user_id', 'cart', ['user_id'])
+    op.create_index('ix_order_table_user_id', 'order_table', ['user_id'])
+    op.create_index('ix_book_title', 'book', ['title'])
+    op.create_index('ix_book_genre', 'book', ['genre'])
+    op.create_index('ix_book_author_book_id', 'book_author', ['book_id'])
+    op.add_column('order_table', sa.Column('order_date', sa.DateTime(), server_default=sa.func.now()))
+    # в моделях баланс был Float - базы, созданные через create_all, приводим к DECIMAL как в init.sql
+    op.alter_column('users', 'balance', type_=sa.Numeric(10, 2), existing_nullable=True, server_default='0')
+
+
+def downgrade():
+    op.drop_column('order_table', 'order_date')
+    op.drop_index('ix_book_author_book_id', table_name='book_author')
+    op.drop_index('ix_book_genre', table_name='book')
+    op.drop_index('ix_book_title', table_name='book')
+    op.drop_index('ix_order_table_user_id', table_name='order_table')
+    op.drop_index('ix_cart_user_id', table_name='cart')
+    op.drop_index('ix_address_user_type', table_name='address')
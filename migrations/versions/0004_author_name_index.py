@@ -0,0 +1,24 @@
+"""индекс имени автора для импорта каталога
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 19:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_author_name', 'author', ['last_name', 'first_name'])
+
+
+def downgrade():
+    op.drop_index('ix_author_name', table_name='author')
@@ -0,0 +1,37 @@
+"""очередь задач по заказам
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'order_job',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('kind', sa.String(50), nullable=False),
+        sa.Column('order_id', sa.Integer(), sa.ForeignKey('order_table.id')),
+        sa.Column('payload', sa.Text()),
+        sa.Column('status', sa.String(20), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('run_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.Text()),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.func.now()),
+    )
+    op.create_index('ix_order_job_status_run_at', 'order_job', ['status', 'run_at'])
+
+
+def downgrade():
+    op.drop_index('ix_order_job_status_run_at', table_name='order_job')
+    op.drop_table('order_job')
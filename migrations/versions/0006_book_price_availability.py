@@ -0,0 +1,35 @@
+"""итоговая цена и доступное количество в book
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 20:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('book', sa.Column('final_price', sa.Numeric(10, 2)))
+    op.execute(
+        'UPDATE book SET final_price = (SELECT ROUND(price * (100 - COALESCE(discount, 0)) / 100, 2) '
+        'FROM product WHERE product.id = book.id)'
+    )
+    op.add_column('book', sa.Column('available_quantity', sa.Integer(),
+                                    sa.Computed('quantity - reserved_quantity', persisted=True)))
+    op.create_index('ix_book_final_price', 'book', ['final_price'])
+    op.create_index('ix_book_available_quantity', 'book', ['available_quantity'])
+
+
+def downgrade():
+    op.drop_index('ix_book_available_quantity', table_name='book')
+    op.drop_index('ix_book_final_price', table_name='book')
+    op.drop_column('book', 'available_quantity')
+    op.drop_column('book', 'final_price')
@@ -0,0 +1,26 @@
+"""индексы для фильтров фасетов каталога
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 21:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_book_publisher', 'book', ['publisher'])
+    op.create_index('ix_book_publish_date', 'book', ['publish_date'])
+
+
+def downgrade():
+    op.drop_index('ix_book_publish_date', table_name='book')
+    op.drop_index('ix_book_publisher', table_name='book')
@@ -0,0 +1,32 @@
+"""дневные итоги продаж для отчетов
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'sales_daily',
+        sa.Column('dimension', sa.String(10), primary_key=True),
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('dimension_key', sa.String(255), primary_key=True, server_default=''),
+        sa.Column('orders', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('units', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('revenue', sa.Numeric(12, 2), nullable=False, server_default='0'),
+    )
+
+
+def downgrade():
+    op.drop_table('sales_daily')
@@ -0,0 +1,31 @@
+"""флаг учета заказа в дневных итогах продаж
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('order_table', sa.Column('counted_in_sales', sa.Boolean(), nullable=False,
+                                           server_default=sa.false()))
+    # заказы, которые уже учтены в sales_daily: как считал flask reports rebuild до этой ревизии
+    op.execute(
+        "UPDATE order_table SET counted_in_sales = 1 WHERE status NOT IN ('обрабатывается', 'отменен') "
+        "OR (status = 'отменен' AND EXISTS (SELECT 1 FROM order_job WHERE order_job.order_id = order_table.id "
+        "AND order_job.kind = 'order_cancelled' AND order_job.status = 'pending'))"
+    )
+
+
+def downgrade():
+    op.drop_column('order_table', 'counted_in_sales')